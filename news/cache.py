@@ -0,0 +1,105 @@
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.encoding import smart_str
+from django.utils.hashcompat import md5_constructor
+
+# number of seconds rendered article pages and the category list are cached
+# for - caching is off unless this is set, and needs a cache backend shared
+# by the web processes and process_news_feeds
+CACHE_TIMEOUT = getattr(settings, 'NEWS_CACHE_TIMEOUT', 0)
+
+CACHE_PREFIX = getattr(settings, 'NEWS_CACHE_PREFIX', 'news')
+
+# version keys outlive the entries they namespace
+VERSION_TIMEOUT = 60 * 60 * 24 * 30
+
+
+def make_key(*parts):
+    digest = md5_constructor(smart_str(u':'.join([smart_str(p) for p in parts])))
+    return '%s:%s' % (CACHE_PREFIX, digest.hexdigest())
+
+def version_key(name):
+    return make_key('version', name)
+
+def get_version(name):
+    """
+    Current version number of a namespace of cache entries.  A lost version
+    starts again from the current time so that it never reuses a number
+    """
+    key = version_key(name)
+    version = cache.get(key)
+    if version is None:
+        version = int(time.time())
+        cache.add(key, version, VERSION_TIMEOUT)
+    return version
+
+def bump_version(name):
+    """
+    Invalidate every cache entry in a namespace by moving to a new version
+    """
+    try:
+        cache.incr(version_key(name))
+    except ValueError:
+        cache.set(version_key(name), int(time.time()), VERSION_TIMEOUT)
+
+def path_prefixes(url_path):
+    """
+    The url_paths of a category and all its ancestors, plus the empty path
+    used by the listing of all articles, i.e. 'a/b/' -> ['', 'a/', 'a/b/']
+    """
+    prefixes = ['']
+    for slug in url_path.split('/')[:-1]:
+        prefixes.append('%s%s/' % (prefixes[-1], slug))
+    return prefixes
+
+def invalidate_categories(url_paths):
+    """
+    Called when articles are added to categories - expires the cached pages
+    of those categories and of every category above them
+    """
+    if not CACHE_TIMEOUT:
+        return
+    names = set()
+    for url_path in url_paths:
+        names.update(path_prefixes(url_path))
+    for name in names:
+        bump_version('articles:%s' % name)
+
+def invalidate_articles(*args, **kwargs):
+    """
+    Expire every cached article page, i.e. when articles are expired
+    """
+    if CACHE_TIMEOUT:
+        bump_version('articles')
+
+def invalidate_category_list(*args, **kwargs):
+    """
+    Expire the cached list of categories - connected to the category model's
+    save and delete signals
+    """
+    if CACHE_TIMEOUT:
+        bump_version('categories')
+
+def page_key(url_path, *parts):
+    """
+    Cache key for a rendered page of a category's articles, which changes
+    whenever articles are added to the category or expired
+    """
+    return make_key('page', get_version('articles'),
+                    get_version('articles:%s' % url_path), url_path, *parts)
+
+def get_category_list():
+    """
+    Every category, served from the cache when caching is enabled
+    """
+    from news.models import Category
+    if not CACHE_TIMEOUT:
+        return Category.objects.all()
+    key = make_key('categories', get_version('categories'))
+    categories = cache.get(key)
+    if categories is None:
+        categories = list(Category.objects.all())
+        cache.set(key, categories, CACHE_TIMEOUT)
+    return categories
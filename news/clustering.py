@@ -0,0 +1,98 @@
+import re
+
+from django.conf import settings
+from django.utils.encoding import smart_str, smart_unicode
+from django.utils.hashcompat import md5_constructor
+from django.utils.html import strip_tags
+
+# group articles that tell the same story into clusters as they come in, and
+# list one article per cluster
+CLUSTER_DUPLICATES = getattr(settings, 'NEWS_CLUSTER_DUPLICATES', False)
+
+# maximum number of bits two fingerprints can differ by for their articles to
+# count as the same story.  Matches within BANDS - 1 bits are always found,
+# matches further apart only when one band of the fingerprints is unchanged
+CLUSTER_DISTANCE = getattr(settings, 'NEWS_CLUSTER_DISTANCE', 6)
+
+# only articles added in the last few days are candidates for a cluster
+CLUSTER_DAYS = getattr(settings, 'NEWS_CLUSTER_DAYS', 3)
+
+# amount of an article's text that goes into its fingerprint - wire copies
+# share their opening paragraphs
+MAX_TEXT_LENGTH = 2000
+
+# fingerprints are 64 bits, split into 4 bands of 16 bits for the index
+BITS = 64
+BANDS = 4
+
+# the votes for every bit are kept in one long integer, LANE bits per bit of
+# the fingerprint, which is wide enough for the words in MAX_TEXT_LENGTH
+LANE = 20
+LANE_MASK = (1 << LANE) - 1
+
+# each byte value spread out into the lanes of its 8 bits
+SPREAD = []
+for byte in range(256):
+    SPREAD.append(sum([1 << (bit * LANE) for bit in range(8) if byte & (1 << bit)]))
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def simhash(text):
+    """
+    64-bit SimHash of a piece of text, as 16 hex digits.  Texts that share
+    most of their pairs of adjacent words get fingerprints that differ in
+    only a few bits.  Returns an empty string for text without words.
+    """
+    words = WORD_RE.findall(smart_unicode(text).lower())
+    features = {}
+    for i in range(max(len(words) - 1, 1)):
+        feature = u' '.join(words[i:i + 2])
+        if feature:
+            features[feature] = features.get(feature, 0) + 1
+    if not features:
+        return ''
+    
+    # count the weight of the features with each bit set, adding all 64
+    # counts at once rather than looping over the bits of every feature
+    votes = 0
+    total = 0
+    for feature, weight in features.items():
+        value = int(md5_constructor(smart_str(feature)).hexdigest()[:BITS // 4], 16)
+        spread = 0
+        for i in range(BITS // 8):
+            spread |= SPREAD[(value >> (i * 8)) & 0xff] << (i * 8 * LANE)
+        votes += spread * weight
+        total += weight
+    
+    # a bit is set when the features with it outweigh those without
+    result = 0
+    for bit in range(BITS):
+        if 2 * ((votes >> (bit * LANE)) & LANE_MASK) > total:
+            result |= 1 << bit
+    return '%016x' % result
+
+def article_simhash(headline, content):
+    """
+    Fingerprint of an article's headline and the start of its text
+    """
+    # only the start of the text is used, so only the start is stripped
+    content = smart_unicode(content, errors='replace')[:MAX_TEXT_LENGTH * 2]
+    text = u'%s %s' % (smart_unicode(headline, errors='replace'),
+                       strip_tags(content))
+    return simhash(text[:MAX_TEXT_LENGTH])
+
+def band_keys(fingerprint):
+    """
+    Index keys for a fingerprint, one per band, i.e. '0:1a2b'.  Fingerprints
+    within BANDS - 1 bits of each other share at least one key.
+    """
+    width = len(fingerprint) // BANDS
+    return ['%d:%s' % (i, fingerprint[i * width:(i + 1) * width])
+            for i in range(BANDS)]
+
+def distance(a, b):
+    """
+    Number of bits that two fingerprints differ by
+    """
+    return bin(int(a, 16) ^ int(b, 16)).count('1')
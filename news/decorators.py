@@ -1,18 +1,16 @@
-import os
+from news.locks import DatabaseLock
 
 def locking(func):
     """
-    Locking to prevent dogpiling
+    Locking to prevent dogpiling - the decorated function is skipped if
+    another process, possibly on another host, is already running it
     """
     def perform_locking(*args, **kwargs):
-        lock_dir = os.path.join(os.path.dirname(__file__), '.lockdir')
-        if not os.path.exists(lock_dir):
+        lock = DatabaseLock('%s.%s' % (func.__module__, func.__name__))
+        if lock.acquire():
             try:
-                os.mkdir(lock_dir)
                 return func(*args, **kwargs)
             finally:
-                os.rmdir(lock_dir)
-        else:
-            pass
+                lock.release()
     
     return perform_locking
@@ -0,0 +1,309 @@
+import logging
+import itertools
+import os
+import socket
+import threading
+import time
+import urllib2
+import urlparse
+from cStringIO import StringIO
+from Queue import Empty, Queue
+
+import feedparser
+
+# number of bytes read from the network at a time
+CHUNK_SIZE = 64 * 1024
+
+
+def open_feed(url, etag=None, modified=None, compressed=False):
+    """
+    Request a feed, sending the validators from its last download so that an
+    unchanged feed comes back as a 304.  Returns the response, or for error
+    and 304 responses the HTTPError, which can be read in the same way.
+    """
+    request = urllib2.Request(url, headers={'User-Agent': feedparser.USER_AGENT})
+    if etag:
+        request.add_header('If-None-Match', etag)
+    if modified:
+        request.add_header('If-Modified-Since', modified)
+    if compressed:
+        request.add_header('Accept-Encoding', 'gzip')
+    try:
+        return urllib2.urlopen(request)
+    except urllib2.HTTPError as e:
+        return e
+
+class DeadlineExceeded(IOError):
+    pass
+
+
+def read_body(response, fh, deadline=None):
+    """
+    Copy the body of a response to a file a chunk at a time, returning the
+    number of bytes read.  Gives up with DeadlineExceeded once time.time()
+    passes ``deadline``.
+    """
+    bytes = 0
+    while True:
+        if deadline and time.time() > deadline:
+            raise DeadlineExceeded("Download of %s took too long" % response.geturl())
+        chunk = response.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        fh.write(chunk)
+        bytes += len(chunk)
+    return bytes
+
+
+class DownloadedResponse(object):
+    """
+    A response that has been read in full, passed to feedparser.parse() in
+    place of the url so that it parses the body along with the status and
+    headers of the download
+    """
+    def __init__(self, response, body):
+        self.url = response.geturl()
+        self.status = response.code
+        self.headers = response.info()
+        self.body = body
+    
+    def info(self):
+        return self.headers
+    
+    def read(self):
+        return self.body
+    
+    def close(self):
+        pass
+
+
+def fetch_parsed(url, etag=None, modified=None, deadline=None):
+    """
+    Download and parse a feed, returning the feedparser result with the
+    number of bytes that were downloaded added as ``bytes``
+    """
+    if '://' not in url:
+        data = feedparser.parse(url)
+        data['bytes'] = os.path.getsize(url)
+        return data
+    
+    response = open_feed(url, etag, modified, compressed=True)
+    body = StringIO()
+    try:
+        bytes = read_body(response, body, deadline)
+    finally:
+        response.close()
+    data = feedparser.parse(DownloadedResponse(response, body.getvalue()))
+    data['bytes'] = bytes
+    return data
+
+
+
+class FeedFetcher(object):
+    """
+    Downloads feeds on a bounded pool of worker threads and hands the parsed
+    results back to the calling thread as they complete.
+
+    Only the network fetch and parse happen on the workers - all database work
+    is left to the caller, so writes stay on a single connection.  No more than
+    ``per_host`` feeds are downloaded from the same host at once, and every
+    socket operation is subject to ``timeout`` seconds.  A feed that takes
+    longer than ``deadline`` seconds altogether is given up on, and its worker
+    replaced, even if the server is still trickling data.
+    """
+    def __init__(self, workers=4, per_host=2, timeout=30, deadline=None):
+        self.workers = max(workers, 1)
+        self.per_host = max(per_host, 1)
+        self.timeout = timeout
+        self.deadline = deadline
+
+    def get_host(self, feed):
+        return urlparse.urlparse(feed.url)[1].lower()
+
+    def fetch_one(self, feed):
+        logging.info("Downloading: %s..." % feed.url)
+        start = time.time()
+        data = feed.fetch_feed(deadline=self.deadline and start + self.deadline)
+        return feed, data, time.time() - start
+
+    def fetch(self, feeds):
+        """
+        Generator yielding a (feed, data, seconds) 3-tuple for every feed, in
+        the order the downloads finish.  ``data`` is None if the download
+        failed.  ``feeds`` can be any iterable; it is only read from the
+        calling thread, a few feeds ahead of the downloads, so it can claim
+        feeds lazily.
+        """
+        old_timeout = socket.getdefaulttimeout()
+        socket.setdefaulttimeout(self.timeout)
+        try:
+            if self.workers == 1 and not self.deadline:
+                for feed in feeds:
+                    yield self.fetch_one(feed)
+            else:
+                for result in self.fetch_concurrently(iter(feeds)):
+                    yield result
+        finally:
+            socket.setdefaulttimeout(old_timeout)
+
+    def fetch_concurrently(self, feeds):
+        pending = []
+        active_hosts = {}
+        # downloads in progress, keyed by id(feed): (feed, host, start, thread)
+        started = {}
+        abandoned = set()
+        # set once ``feeds`` has run dry, so idle workers exit
+        state = {'exhausted': False}
+        condition = threading.Condition()
+        results = Queue()
+
+        def next_feed():
+            # pick the first pending feed whose host is not already saturated,
+            # waiting for more feeds or for a download to finish otherwise
+            condition.acquire()
+            try:
+                while pending or not state['exhausted']:
+                    for i, feed in enumerate(pending):
+                        host = self.get_host(feed)
+                        if active_hosts.get(host, 0) < self.per_host:
+                            active_hosts[host] = active_hosts.get(host, 0) + 1
+                            started[id(feed)] = (feed, host, time.time(),
+                                                 threading.currentThread())
+                            return pending.pop(i), host
+                    condition.wait()
+                return None, None
+            finally:
+                condition.release()
+
+        def startable():
+            # pending feeds that workers could start on right away
+            hosts = dict(active_hosts)
+            count = 0
+            for feed in pending:
+                host = self.get_host(feed)
+                if hosts.get(host, 0) < self.per_host:
+                    hosts[host] = hosts.get(host, 0) + 1
+                    count += 1
+            return count
+
+        def refill():
+            # keep a feed that can be started queued for every worker, so a
+            # busy host does not leave the others idle.  ``feeds`` is only
+            # read on this thread; returns the number of feeds added
+            added = 0
+            while not state['exhausted']:
+                condition.acquire()
+                try:
+                    wanted = self.workers - startable()
+                finally:
+                    condition.release()
+                if wanted <= 0:
+                    break
+                more = list(itertools.islice(feeds, wanted))
+                condition.acquire()
+                try:
+                    pending.extend(more)
+                    if len(more) < wanted:
+                        state['exhausted'] = True
+                    condition.notifyAll()
+                finally:
+                    condition.release()
+                added += len(more)
+            return added
+
+        def finish(feed, host):
+            # returns False if the download was already given up on
+            condition.acquire()
+            try:
+                if started.pop(id(feed), None) is None:
+                    return False
+                active_hosts[host] -= 1
+                condition.notifyAll()
+                return True
+            finally:
+                condition.release()
+
+        def give_up(now):
+            condition.acquire()
+            try:
+                overdue = []
+                for key, (feed, host, start, thread) in list(started.items()):
+                    if now - start >= self.deadline:
+                        del started[key]
+                        active_hosts[host] -= 1
+                        abandoned.add(thread)
+                        overdue.append((feed, now - start))
+                condition.notifyAll()
+                return overdue
+            finally:
+                condition.release()
+
+        def next_timeout():
+            if not self.deadline:
+                return None
+            condition.acquire()
+            try:
+                starts = [start for feed, host, start, thread in started.values()]
+            finally:
+                condition.release()
+            if not starts:
+                return self.deadline
+            return max(min(starts) + self.deadline - time.time(), 0)
+
+        def worker():
+            while True:
+                feed, host = next_feed()
+                if feed is None:
+                    break
+                try:
+                    result = self.fetch_one(feed)
+                except:
+                    result = (feed, None, 0)
+                if not finish(feed, host):
+                    # a replacement worker has already taken over
+                    break
+                results.put(result)
+
+        threads = []
+
+        def start_worker():
+            thread = threading.Thread(target=worker)
+            thread.setDaemon(True)
+            thread.start()
+            threads.append(thread)
+
+        remaining = refill()
+        for i in range(min(self.workers, remaining)):
+            start_worker()
+
+        try:
+            while remaining:
+                try:
+                    result = results.get(True, next_timeout())
+                except Empty:
+                    for feed, seconds in give_up(time.time()):
+                        logging.warn("Gave up on %s after %d seconds" % (feed.url, seconds))
+                        start_worker()
+                        remaining -= 1
+                        remaining += refill()
+                        yield feed, None, seconds
+                    continue
+                # top up the queue before handing the result over, so the
+                # workers are kept busy while it is processed
+                remaining += refill() - 1
+                yield result
+        finally:
+            # stop the workers picking up anything else if the caller gives up
+            # part of the way through
+            condition.acquire()
+            try:
+                del pending[:]
+                state['exhausted'] = True
+                condition.notifyAll()
+            finally:
+                condition.release()
+
+        # stuck workers are daemon threads and die with the process
+        for thread in threads:
+            if thread not in abandoned:
+                thread.join()
@@ -0,0 +1,140 @@
+import datetime
+import logging
+import time
+
+from django.conf import settings
+from django.db import connection
+from django.utils import simplejson
+
+
+def response_size(data):
+    """
+    Size in bytes of a downloaded feed, as counted while it was read - falls
+    back on what the server reported for results from elsewhere
+    """
+    if getattr(data, 'bytes', None):
+        return data.bytes
+    try:
+        return int(data.get('headers', {}).get('content-length', 0))
+    except (AttributeError, TypeError, ValueError):
+        return 0
+
+
+class IngestStats(object):
+    """
+    Where the time goes while a feed is processed.  Stages are timed like the
+    laps of a stopwatch - each call to lap() records the time since the last
+    one under the given stage name.  Queries are only counted while
+    settings.DEBUG is on, since Django does not log them otherwise.
+    """
+    def __init__(self, url=''):
+        self.url = url
+        self.stages = {}
+        self.stage_order = []
+        self.bytes = 0
+        self.entries = 0
+        self.new_articles = 0
+        self.error = False
+        self.reset()
+    
+    def reset(self):
+        self.lap_time = time.time()
+        self.lap_queries = len(connection.queries)
+    
+    def lap(self, name):
+        now = time.time()
+        queries = len(connection.queries)
+        if settings.DEBUG:
+            self.add(name, now - self.lap_time, queries - self.lap_queries)
+        else:
+            self.add(name, now - self.lap_time)
+        self.lap_time = now
+        self.lap_queries = queries
+    
+    def add(self, name, seconds, queries=None):
+        if name not in self.stages:
+            self.stages[name] = {'seconds': 0.0, 'queries': queries}
+            self.stage_order.append(name)
+        elif queries is not None:
+            self.stages[name]['queries'] = (self.stages[name]['queries'] or 0) + queries
+        self.stages[name]['seconds'] += seconds
+    
+    def total(self):
+        return sum([stage['seconds'] for stage in self.stages.values()])
+    
+    def queries(self):
+        counts = [stage['queries'] for stage in self.stages.values() 
+                  if stage['queries'] is not None]
+        if counts:
+            return sum(counts)
+        return None
+    
+    def as_dict(self):
+        return {
+            'url': self.url,
+            'seconds': self.total(),
+            'queries': self.queries(),
+            'bytes': self.bytes,
+            'entries': self.entries,
+            'new_articles': self.new_articles,
+            'error': self.error,
+            'stages': [dict(name=name, **self.stages[name]) for name in self.stage_order],
+        }
+
+
+class IngestReport(object):
+    """
+    Collects the IngestStats of every feed processed in a run
+    """
+    def __init__(self):
+        self.started = datetime.datetime.now()
+        self.feeds = []
+    
+    def add(self, stats):
+        self.feeds.append(stats)
+    
+    def stage_totals(self):
+        totals = {}
+        order = []
+        for stats in self.feeds:
+            for name in stats.stage_order:
+                if name not in totals:
+                    totals[name] = {'seconds': 0.0, 'queries': None}
+                    order.append(name)
+                totals[name]['seconds'] += stats.stages[name]['seconds']
+                if stats.stages[name]['queries'] is not None:
+                    totals[name]['queries'] = (totals[name]['queries'] or 0) + \
+                        stats.stages[name]['queries']
+        return [dict(name=name, **totals[name]) for name in order]
+    
+    def slowest(self, n):
+        feeds = list(self.feeds)
+        feeds.sort(key=lambda stats: stats.total(), reverse=True)
+        return feeds[:n]
+    
+    def log_summary(self, n=10):
+        logging.info("Time by stage:")
+        for stage in sorted(self.stage_totals(), key=lambda s: s['seconds'], reverse=True):
+            queries = stage['queries'] is not None and ', %d queries' % stage['queries'] or ''
+            logging.info("  %-10s %fs%s" % (stage['name'], stage['seconds'], queries))
+        
+        logging.info("Slowest feeds:")
+        for stats in self.slowest(n):
+            stages = ', '.join(['%s %.2fs' % (name, stats.stages[name]['seconds'])
+                                for name in stats.stage_order])
+            logging.info("  %fs %s (%d entries, %d bytes: %s)" % (stats.total(),
+                stats.url, stats.entries, stats.bytes, stages))
+    
+    def as_dict(self):
+        return {
+            'started': self.started.isoformat(),
+            'feeds': [stats.as_dict() for stats in self.feeds],
+            'stages': self.stage_totals(),
+        }
+    
+    def write(self, filename):
+        fh = open(filename, 'w')
+        try:
+            simplejson.dump(self.as_dict(), fh, indent=2)
+        finally:
+            fh.close()
@@ -0,0 +1,139 @@
+import datetime
+import logging
+import os
+import random
+import socket
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+
+# seconds without a heartbeat after which a lock is considered abandoned
+LOCK_TIMEOUT = getattr(settings, 'NEWS_LOCK_TIMEOUT', 15 * 60)
+
+# seconds a worker may hold on to a feed it has claimed
+LEASE_TIMEOUT = getattr(settings, 'NEWS_LEASE_TIMEOUT', 10 * 60)
+
+
+def make_owner():
+    """
+    An identifier for this process that is unique across hosts
+    """
+    return '%s:%d:%06x' % (socket.gethostname(), os.getpid(),
+                           random.randint(0, 0xffffff))
+
+
+class DatabaseLock(object):
+    """
+    A named lock stored in the database, so that it is shared by every
+    process and host using the same database.  The holder records a
+    heartbeat with refresh(); a lock whose heartbeat is older than the
+    timeout is treated as abandoned (i.e. the process was killed) and can be
+    taken over.
+    """
+    def __init__(self, name, timeout=LOCK_TIMEOUT, owner=None):
+        self.name = name
+        self.timeout = timeout
+        self.owner = owner or make_owner()
+        self.last_heartbeat = None
+    
+    def acquire(self):
+        """
+        Try to take the lock without waiting, returning whether it was taken
+        """
+        from news.models import Lock
+        now = datetime.datetime.now()
+        try:
+            Lock.objects.create(name=self.name, owner=self.owner, acquired=now,
+                                heartbeat=now)
+            transaction.commit_unless_managed()
+            self.last_heartbeat = now
+            return True
+        except IntegrityError:
+            transaction.rollback_unless_managed()
+        
+        # the conditional update means only one process can take over a
+        # stale lock
+        stale = now - datetime.timedelta(seconds=self.timeout)
+        taken = Lock.objects.filter(name=self.name, heartbeat__lt=stale).update(
+            owner=self.owner, acquired=now, heartbeat=now)
+        transaction.commit_unless_managed()
+        if taken:
+            logging.warn("Took over stale lock %s" % self.name)
+            self.last_heartbeat = now
+        return bool(taken)
+    
+    def refresh(self):
+        """
+        Record a heartbeat, returning False if the lock has been lost.  The
+        database is only written to every tenth of the timeout.
+        """
+        from news.models import Lock
+        now = datetime.datetime.now()
+        if self.last_heartbeat and now - self.last_heartbeat < \
+           datetime.timedelta(seconds=self.timeout / 10.0):
+            return True
+        held = Lock.objects.filter(name=self.name, owner=self.owner).update(
+            heartbeat=now)
+        transaction.commit_unless_managed()
+        self.last_heartbeat = now
+        return bool(held)
+    
+    def release(self):
+        from news.models import Lock
+        Lock.objects.filter(name=self.name, owner=self.owner).delete()
+        transaction.commit_unless_managed()
+
+
+def claim_feeds(queryset, owner, count, timeout=LEASE_TIMEOUT):
+    """
+    Lease up to ``count`` feeds from the queryset that no other worker holds
+    a current lease on, and return them.  Workers on any number of hosts can
+    claim feeds at the same time without being handed the same feed; an
+    empty list means there was nothing left to claim.
+    """
+    from news.models import Feed
+    while True:
+        now = datetime.datetime.now()
+        available = Q(lease_expires__isnull=True) | Q(lease_expires__lt=now)
+        
+        # pick from a wider window than needed, so that workers starting
+        # together don't all go for the same rows
+        window = list(queryset.filter(available).values_list('id', flat=True)[:count * 4])
+        if not window:
+            return []
+        candidates = random.sample(window, min(count, len(window)))
+        
+        # another worker may have claimed some of the candidates in the
+        # meantime, in which case the update skips them
+        Feed.objects.filter(available, pk__in=candidates).update(lease_owner=owner,
+            lease_expires=now + datetime.timedelta(seconds=timeout))
+        transaction.commit_unless_managed()
+        claimed = list(Feed.objects.filter(pk__in=candidates, lease_owner=owner))
+        if claimed:
+            return claimed
+        # lost the race for every candidate, which are leased now so the next
+        # attempt picks different ones
+
+def renew_lease(feed, owner, timeout=LEASE_TIMEOUT):
+    """
+    Extend the lease on a feed before working on it, returning False if
+    another worker has claimed it since
+    """
+    from news.models import Feed
+    expires = datetime.datetime.now() + datetime.timedelta(seconds=timeout)
+    renewed = Feed.objects.filter(pk=feed.pk, lease_owner=owner).update(
+        lease_expires=expires)
+    transaction.commit_unless_managed()
+    # keep the instance in step, it is saved once the feed is processed
+    feed.lease_expires = expires
+    return bool(renewed)
+
+def release_feed(feed, owner):
+    """
+    Give up the lease on a feed once it has been processed
+    """
+    from news.models import Feed
+    Feed.objects.filter(pk=feed.pk, lease_owner=owner).update(lease_owner='',
+        lease_expires=None)
+    transaction.commit_unless_managed()
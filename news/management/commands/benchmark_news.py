@@ -0,0 +1,200 @@
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from email.Utils import formatdate
+from optparse import make_option
+from BaseHTTPServer import HTTPServer
+from SimpleHTTPServer import SimpleHTTPRequestHandler
+
+from django.conf import settings
+from django.core.management.base import NoArgsCommand
+from django.db import connection
+from django.utils.html import escape
+from news.instrumentation import IngestReport, IngestStats
+from news.models import Source, Feed, Category, CategoryRelationship, \
+    FeedCategoryRelationship, WhiteListFilter
+
+VOCABULARY_SIZE = 2000
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+class Command(NoArgsCommand):
+    help = "Benchmark feed processing against generated feeds in a test database."
+    option_list = NoArgsCommand.option_list + (
+        make_option('--feeds', action='store', type='int', dest='feeds',
+            default=20, help='Number of feeds to generate.'),
+        make_option('--entries', action='store', type='int', dest='entries',
+            default=100, help='Number of entries in each feed.'),
+        make_option('--words', action='store', type='int', dest='words',
+            default=200, help='Number of words in the content of each entry.'),
+        make_option('--depth', action='store', type='int', dest='depth',
+            default=3, help='Depth of the generated category tree.'),
+        make_option('--branching', action='store', type='int', dest='branching',
+            default=3, help='Number of subcategories under each category.'),
+        make_option('--keywords', action='store', type='int', dest='keywords',
+            default=20, help='Number of keywords in each whitelist.'),
+        make_option('--rounds', action='store', type='int', dest='rounds',
+            default=2, help='Number of times to process every feed.'),
+        make_option('--http', action='store_true', dest='http',
+            help='Serve the feeds over HTTP from localhost instead of reading files.'),
+        make_option('--report', action='store', dest='report',
+            help='Write per-feed timings for every round to this file as JSON.'),
+    )
+    
+    def handle_noargs(self, **options):
+        """
+        Generate a taxonomy and a set of feeds in a throwaway database, then
+        time processing the feeds.  The first round inserts every entry, later
+        rounds measure the cost of entries that are already known.
+        """
+        random.seed(0)
+        self.vocabulary = ['word%d' % i for i in range(VOCABULARY_SIZE)]
+        
+        old_name = settings.DATABASE_NAME
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        feed_dir = tempfile.mkdtemp()
+        cwd = os.getcwd()
+        server = None
+        try:
+            base_url = feed_dir + os.sep
+            if options['http']:
+                server, base_url = self.serve(feed_dir)
+            
+            leaves = self.build_taxonomy(options['depth'], options['branching'],
+                                         options['keywords'])
+            feeds = self.build_feeds(feed_dir, base_url, leaves, options)
+            
+            # django only logs queries in debug mode
+            settings.DEBUG = True
+            for round in range(options['rounds']):
+                report = self.run(feeds)
+                self.summarize(round + 1, report)
+                if options['report']:
+                    report.write('%s.%d' % (options['report'], round + 1))
+        finally:
+            if server:
+                server.shutdown()
+                os.chdir(cwd)
+            shutil.rmtree(feed_dir)
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+    
+    def serve(self, feed_dir):
+        # SimpleHTTPRequestHandler serves the current directory
+        os.chdir(feed_dir)
+        server = HTTPServer(('127.0.0.1', 0), QuietHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        return server, 'http://127.0.0.1:%d/' % server.server_port
+    
+    def sentence(self, length):
+        return ' '.join([random.choice(self.vocabulary) for i in range(length)])
+    
+    def build_taxonomy(self, depth, branching, keywords):
+        """
+        Build a tree of categories where every category includes the articles
+        of its children, half of them through a whitelist.  Returns the leaf
+        categories.
+        """
+        whitelist = WhiteListFilter.objects.create(name='benchmark',
+            keywords=','.join(random.sample(self.vocabulary, keywords)))
+        
+        level = [Category.objects.create(name='root', slug='root')]
+        for level_number in range(depth):
+            children = []
+            for parent in level:
+                for i in range(branching):
+                    slug = '%s-%d' % (parent.slug, i)
+                    child = Category.objects.create(name=slug, slug=slug, parent=parent)
+                    relationship = CategoryRelationship.objects.create(
+                        category=parent, included_category=child)
+                    if i % 2:
+                        relationship.white_list.add(whitelist)
+                    children.append(child)
+            level = children
+        return level
+    
+    def build_feeds(self, feed_dir, base_url, leaves, options):
+        source = Source.objects.create(name='Benchmark', url='http://localhost/')
+        whitelist = WhiteListFilter.objects.get(name='benchmark')
+        feeds = []
+        for i in range(options['feeds']):
+            format = i % 2 and 'atom' or 'rss'
+            filename = 'feed%d.xml' % i
+            fh = open(os.path.join(feed_dir, filename), 'w')
+            try:
+                fh.write(self.generate_feed(i, format, options['entries'], options['words']))
+            finally:
+                fh.close()
+            
+            feed = Feed.objects.create(name=filename, url=base_url + filename,
+                                       source=source)
+            for j, category in enumerate(random.sample(leaves, min(len(leaves), 3))):
+                relationship = FeedCategoryRelationship.objects.create(
+                    feed=feed, category=category)
+                if j % 2:
+                    relationship.white_list.add(whitelist)
+            feeds.append(feed)
+        return feeds
+    
+    def generate_feed(self, n, format, entries, words):
+        now = time.time()
+        items = []
+        for i in range(entries):
+            published = now - i * 600
+            headline = escape(self.sentence(8))
+            content = escape('<p>%s</p>' % self.sentence(words))
+            link = 'http://localhost/feed%d/%d/' % (n, i)
+            if format == 'atom':
+                items.append('<entry><title>%s</title><link href="%s"/><id>%s</id>'
+                    '<updated>%s</updated><summary type="html">%s</summary></entry>' % (
+                    headline, link, link, time.strftime('%Y-%m-%dT%H:%M:%SZ', 
+                    time.gmtime(published)), content))
+            else:
+                items.append('<item><title>%s</title><link>%s</link><guid>%s</guid>'
+                    '<pubDate>%s</pubDate><description>%s</description></item>' % (
+                    headline, link, link, formatdate(published), content))
+        
+        if format == 'atom':
+            return '<?xml version="1.0" encoding="utf-8"?>\n' \
+                   '<feed xmlns="http://www.w3.org/2005/Atom"><title>Feed %d</title>' \
+                   '%s</feed>' % (n, ''.join(items))
+        return '<?xml version="1.0" encoding="utf-8"?>\n' \
+               '<rss version="2.0"><channel><title>Feed %d</title>%s</channel></rss>' % (
+               n, ''.join(items))
+    
+    def run(self, feeds):
+        report = IngestReport()
+        for feed in feeds:
+            connection.queries = []
+            stats = IngestStats(feed.url)
+            if feed.download_feed(stats=stats) == False:
+                stats.error = True
+            report.add(stats)
+        return report
+    
+    def summarize(self, round, report):
+        entries = sum([stats.entries for stats in report.feeds])
+        new_articles = sum([stats.new_articles for stats in report.feeds])
+        seconds = sum([stats.total() for stats in report.feeds])
+        queries = sum([stats.queries() or 0 for stats in report.feeds])
+        errors = len([stats for stats in report.feeds if stats.error])
+        
+        write = sys.stdout.write
+        write("Round %d: %d feeds, %d entries, %d new articles, %d errors\n" % (
+            round, len(report.feeds), entries, new_articles, errors))
+        write("  %.2f seconds, %.1f entries/sec, %.2f queries/entry\n" % (
+            seconds, entries / (seconds or 1), float(queries) / (entries or 1)))
+        for stage in report.stage_totals():
+            write("  %-10s %8.3fs %6d queries\n" % (stage['name'], stage['seconds'],
+                                                   stage['queries'] or 0))
+        # ru_maxrss is reported in kilobytes on linux
+        write("  peak memory %.1f MB\n" % (
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
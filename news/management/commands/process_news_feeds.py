@@ -4,10 +4,16 @@ import os
 import time
 from optparse import make_option
 from django.conf import settings
-from django.core.management.base import NoArgsCommand
+from django.core.management.base import CommandError, NoArgsCommand
+from django.db import connection
 from django.db.models import Q
-from news.decorators import locking
+from news.fetcher import FeedFetcher
+from news.instrumentation import IngestReport, IngestStats, response_size
+from news.locks import DatabaseLock, claim_feeds, make_owner, release_feed, \
+    renew_lease
 from news.models import Feed, Article
+from news.syndication import prerender_feeds
+from news.utils import chunked
 
 class Command(NoArgsCommand):
     help = "Can be run as a cronjob or directly to download RSS feeds."
@@ -16,12 +22,54 @@ class Command(NoArgsCommand):
             '--verbose', action='store_true', dest='verbose',
             help='Log output to console.'
         ),
+        make_option(
+            '--workers', action='store', type='int', dest='workers', default=1,
+            help='Number of feeds to download concurrently.'
+        ),
+        make_option(
+            '--per-host', action='store', type='int', dest='per_host',
+            default=2, help='Maximum concurrent downloads from a single host.'
+        ),
+        make_option(
+            '--timeout', action='store', type='int', dest='timeout',
+            default=30, help='Socket timeout, in seconds, for each download.'
+        ),
+        make_option(
+            '--deadline', action='store', type='int', dest='deadline',
+            default=300, help='Give up on a download after this many seconds; 0 waits forever.'
+        ),
+        make_option(
+            '--all', action='store_true', dest='all',
+            help='Download every active feed, not just the ones that are due.'
+        ),
+        make_option(
+            '--slowest', action='store', type='int', dest='slowest', default=10,
+            help='Number of slowest feeds to list in the timing summary.'
+        ),
+        make_option(
+            '--report', action='store', dest='report',
+            help='Write per-feed timings for the run to this file as JSON.'
+        ),
+        make_option(
+            '--count-queries', action='store_true', dest='count_queries',
+            help='Count the queries run for each feed (turns on DEBUG).'
+        ),
+        make_option(
+            '--leases', action='store_true', dest='leases',
+            help='Share due feeds with other workers by leasing them in batches.'
+        ),
+        make_option(
+            '--batch-size', action='store', type='int', dest='batch_size',
+            default=20, help='Number of feeds leased at a time.'
+        ),
     )
-    @locking
     def handle_noargs(self, **options):
         """
         Update the database with articles
         """
+        if options.get('leases') and options.get('all'):
+            raise CommandError('--all cannot be combined with --leases')
+        
         verbose = options.get('verbose', False)
         logging.basicConfig(
             filename='news_log.log',
@@ -35,24 +83,139 @@ class Command(NoArgsCommand):
             formatter = logging.Formatter('%(name)-12s: %(levelname)-8s %(message)s')
             console.setFormatter(formatter)
             logging.getLogger('').addHandler(console)
-
+        
+        if options.get('leases'):
+            # feeds are shared out between workers through per-feed leases,
+            # so any number of workers can run at once
+            self.lock = None
+            self.download(options)
+        else:
+            self.lock = DatabaseLock('process_news_feeds')
+            if not self.lock.acquire():
+                logging.info('Feeds are already being downloaded by another process')
+                return
+            try:
+                self.download(options)
+            finally:
+                self.lock.release()
+        
+        # expiring and purging only needs one process at a time
+        lock = DatabaseLock('expire_articles')
+        if lock.acquire():
+            try:
+                expired_articles = Article.objects.expire_articles()
+                logging.info("Expired articles: %s" % expired_articles)
+                
+                purged_articles = Article.objects.purge_articles()
+                logging.info("Purged articles: %s" % purged_articles)
+                
+                Article.objects.prune_clusters()
+                
+                # serialize the feeds that changed during this run now, rather
+                # than on the first request for each of them
+                prerender_feeds()
+            finally:
+                lock.release()
+    
+    def download(self, options):
         logging.info('Download starting')
         total_start = time.time()
-        new_articles = 0
         
-        for feed in Feed.objects.filter(active=True):
-            start = time.time()
-            logging.info("Downloading: %s..." % feed.url)
-            result = feed.download_feed()
+        fetcher = FeedFetcher(
+            workers=options.get('workers') or 1,
+            per_host=options.get('per_host') or 2,
+            timeout=options.get('timeout') or 30,
+            deadline=options.get('deadline') or None,
+        )
+        
+        feeds = Feed.objects.filter(active=True)
+        if not options.get('all'):
+            feeds = feeds.filter(Q(next_download__isnull=True) |
+                                 Q(next_download__lte=datetime.datetime.now()))
+        
+        # django only logs queries in debug mode
+        self.count_queries = options.get('count_queries', False)
+        if self.count_queries:
+            settings.DEBUG = True
+        report = IngestReport()
+        
+        owner = make_owner()
+        batch_size = options.get('batch_size') or 20
+        claimed = {}
+        leased = self.lease_feeds(feeds, owner, batch_size,
+                                  options.get('leases'), claimed)
+        self.process_feeds(fetcher, leased, report, owner, claimed)
+        
+        new_articles = sum([stats.new_articles for stats in report.feeds])
+        total_end = time.time()
+        logging.info("Finished processing %d feeds" % len(report.feeds))
+        logging.info("%d new articles added in %f seconds" % (new_articles, total_end - total_start))
+        report.log_summary(options.get('slowest', 10))
+        if options.get('report'):
+            report.write(options['report'])
+    
+    def lease_feeds(self, feeds, owner, batch_size, leases, claimed):
+        """
+        Generator claiming feeds a batch at a time as the fetcher asks for
+        them, and recording the ones claimed but not processed yet in
+        ``claimed``
+        """
+        if leases:
+            # processed feeds are rescheduled and feeds still being worked
+            # on are leased, so neither is claimed twice
+            def batches():
+                while True:
+                    batch = claim_feeds(feeds, owner, batch_size)
+                    if not batch:
+                        break
+                    yield batch
+        else:
+            # every feed is leased here too, so that feeds being processed
+            # by workers started with --leases are skipped
+            def batches():
+                for chunk in chunked(list(feeds.values_list('id', flat=True)), batch_size):
+                    yield claim_feeds(Feed.objects.filter(pk__in=chunk), owner,
+                                      len(chunk))
+        for batch in batches():
+            for feed in batch:
+                claimed[feed.pk] = feed
+                yield feed
+    
+    def process_feeds(self, fetcher, feeds, report, owner, claimed):
+        """
+        Download and process the feeds leased by owner, stopping if the
+        download lock is lost part of the way through
+        """
+        # feeds are downloaded by the fetcher's worker pool, but processed
+        # (and written to the database) one at a time on this thread
+        results = fetcher.fetch(feeds)
+        for feed, data, fetch_time in results:
+            claimed.pop(feed.pk, None)
+            if not renew_lease(feed, owner):
+                # the lease ran out while the feed was queued and another
+                # worker has it now
+                logging.warn("Lost the lease on %s, skipping" % feed.url)
+                continue
+            if self.count_queries:
+                connection.queries = []
+            stats = IngestStats(feed.url)
+            stats.add('fetch', fetch_time)
+            if data is None:
+                feed.download_failed()
+                result = False
+            else:
+                stats.bytes = response_size(data)
+                result = feed.download_feed(data, stats)
             if result == False:
+                stats.error = True
                 logging.warn("Error downloading %s" % feed.url)    
-            end = time.time()
-            logging.info("%d new articles found (took %fs)" % (feed.new_articles_added, end - start))
-            new_articles += feed.new_articles_added
+            report.add(stats)
+            logging.info("%d new articles found (took %fs)" % (stats.new_articles, stats.total()))
             
-        total_end = time.time()
-        logging.info("Finished processing %d feeds" % Feed.objects.filter(active=True).count())
-        logging.info("%d new articles added in %f seconds" % (new_articles, total_end - total_start))
-        
-        expired_articles = Article.objects.expire_articles()
-        logging.info("Expired articles: %s" % expired_articles)
+            release_feed(feed, owner)
+            if self.lock and not self.lock.refresh():
+                logging.warn("Lost the download lock, stopping")
+                results.close()
+                for feed in claimed.values():
+                    release_feed(feed, owner)
+                break
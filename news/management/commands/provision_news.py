@@ -0,0 +1,62 @@
+import csv
+import os
+import sys
+from xml.parsers.expat import ExpatError
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from news.provisioning import ProvisioningError, dump, load, read_csv, \
+    read_opml, write_csv, write_opml
+
+READERS = {'opml': read_opml, 'csv': read_csv}
+WRITERS = {'opml': write_opml, 'csv': write_csv}
+
+class Command(BaseCommand):
+    help = "Import or export sources, feeds, categories and white-lists as OPML or CSV."
+    args = '<import|export> <file>'
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--format', action='store', dest='format',
+            help='opml or csv - taken from the file extension by default.'
+        ),
+    )
+    
+    def handle(self, *args, **options):
+        if len(args) != 2 or args[0] not in ('import', 'export'):
+            raise CommandError('Usage: provision_news %s' % self.args)
+        action, filename = args
+        
+        format = options.get('format') or os.path.splitext(filename)[1][1:].lower()
+        if format not in READERS:
+            raise CommandError('Unknown format %r, use --format=opml or --format=csv' % format)
+        
+        if action == 'export':
+            if filename == '-':
+                WRITERS[format](dump(), sys.stdout)
+            else:
+                fh = open(filename, 'wb')
+                try:
+                    WRITERS[format](dump(), fh)
+                finally:
+                    fh.close()
+            return
+        
+        try:
+            if filename == '-':
+                fh = sys.stdin
+            else:
+                fh = open(filename, 'rb')
+            try:
+                definitions = READERS[format](fh)
+            finally:
+                fh.close()
+            created = transaction.commit_on_success(load)(definitions)
+        except (IOError, UnicodeDecodeError, ProvisioningError, ExpatError,
+                SyntaxError, csv.Error) as e:
+            # SyntaxError covers the ParseError of newer ElementTrees, and
+            # UnicodeDecodeError a CSV file that is not UTF-8
+            raise CommandError('Could not import %s: %s' % (filename, e))
+        
+        for name in ('sources', 'whitelists', 'categories', 'feeds',
+                     'feed_categories', 'includes'):
+            sys.stdout.write("Created %d %s\n" % (created[name], name.replace('_', ' ')))
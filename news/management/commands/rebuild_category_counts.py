@@ -0,0 +1,36 @@
+import sys
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+from django.db.models import Count, Max
+from news.cache import invalidate_category_list
+from news.models import Category
+from news.utils import chunked
+
+class Command(NoArgsCommand):
+    help = "Recount the articles in every category and find their latest publish dates."
+    
+    def handle_noargs(self, **options):
+        """
+        Recompute the cached article count and latest publish date of every
+        category from scratch, with a handful of grouped queries
+        """
+        self.rebuild()
+        invalidate_category_list()
+        sys.stdout.write("Updated %d categories\n" % Category.objects.count())
+    
+    @transaction.commit_on_success
+    def rebuild(self):
+        Category.objects.update(article_count=0, latest_publish=None)
+        
+        counts = Category.objects.filter(articles__expired=False).annotate(
+            num_articles=Count('articles')).values_list('id', 'num_articles')
+        Category.objects.adjust_counts(dict(counts))
+        
+        by_date = {}
+        for pk, latest in Category.objects.annotate(
+            latest=Max('articles__publish')).values_list('id', 'latest'):
+            if latest is not None:
+                by_date.setdefault(latest, []).append(pk)
+        for latest, pks in by_date.items():
+            for chunk in chunked(pks, 500):
+                Category.objects.filter(pk__in=chunk).update(latest_publish=latest)
@@ -0,0 +1,32 @@
+import sys
+from django.core.management.base import NoArgsCommand
+from django.db import connection, transaction
+from news.models import Article, ArticleTerm
+from news.search import get_search_backend
+
+class Command(NoArgsCommand):
+    help = "Rebuild the article search index from scratch."
+    
+    batch_size = 500
+    
+    def handle_noargs(self, **options):
+        """
+        Clear the index and re-index every article, a batch at a time
+        """
+        cursor = connection.cursor()
+        cursor.execute('DELETE FROM %s' % connection.ops.quote_name(
+            ArticleTerm._meta.db_table))
+        transaction.commit_unless_managed()
+        
+        backend = get_search_backend()
+        last_pk = 0
+        indexed = 0
+        while True:
+            articles = list(Article.objects.filter(pk__gt=last_pk).order_by('pk')[:self.batch_size])
+            if not articles:
+                break
+            backend.index(articles)
+            last_pk = articles[-1].pk
+            indexed += len(articles)
+        
+        sys.stdout.write("Indexed %d articles\n" % indexed)
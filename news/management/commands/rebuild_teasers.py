@@ -0,0 +1,40 @@
+import sys
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+from news.cache import invalidate_articles
+from news.models import Article, TEASER_WORDS, TEASER_MAX_LENGTH
+from news.utils import make_teaser
+
+class Command(NoArgsCommand):
+    help = "Make the listing teaser of every article that does not have one."
+    
+    batch_size = 500
+    
+    def handle_noargs(self, **options):
+        """
+        Fill in missing teasers a batch at a time, reading only the article
+        text and writing only the teaser
+        """
+        last_pk = 0
+        updated = 0
+        while True:
+            rows = list(Article.objects.filter(pk__gt=last_pk, teaser='').order_by(
+                'pk').values_list('id', 'content')[:self.batch_size])
+            if not rows:
+                break
+            updated += self.fill(rows)
+            last_pk = rows[-1][0]
+        
+        if updated:
+            invalidate_articles()
+        sys.stdout.write("Updated %d articles\n" % updated)
+    
+    @transaction.commit_on_success
+    def fill(self, rows):
+        updated = 0
+        for pk, content in rows:
+            teaser = make_teaser(content, TEASER_WORDS, TEASER_MAX_LENGTH)
+            if teaser:
+                Article.objects.filter(pk=pk).update(teaser=teaser)
+                updated += 1
+        return updated
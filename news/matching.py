@@ -0,0 +1,204 @@
+import re
+import threading
+import time
+
+from django.conf import settings
+from django.utils.encoding import smart_unicode
+
+from news.routing import CategoryGraph
+from news.utils import m2m_pairs
+
+# whitelists with more keywords than this are matched with an Aho-Corasick
+# automaton rather than one big alternation regex
+AHO_CORASICK_THRESHOLD = getattr(settings, 'NEWS_AHO_CORASICK_THRESHOLD', 50)
+
+# number of seconds compiled whitelists are reused before being reloaded, so
+# long-running processes pick up changes made elsewhere
+WHITELIST_CACHE_TIMEOUT = getattr(settings, 'NEWS_WHITELIST_CACHE_TIMEOUT', 300)
+
+
+def parse_keywords(keyword_lists):
+    """
+    Turn a list of comma separated keyword strings into a sorted tuple of
+    unique, lowercased keywords
+    """
+    keywords = set()
+    for keyword_list in keyword_lists:
+        for keyword in smart_unicode(keyword_list).split(','):
+            if keyword.strip():
+                keywords.add(keyword.strip().lower())
+    return tuple(sorted(keywords))
+
+
+class AhoCorasick(object):
+    """
+    Multi-pattern substring matcher - the text is scanned once, no matter how
+    many keywords there are
+    """
+    def __init__(self, keywords):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [False]
+        
+        for keyword in keywords:
+            state = 0
+            for char in keyword:
+                if char not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(False)
+                    self.goto[state][char] = len(self.goto) - 1
+                state = self.goto[state][char]
+            self.output[state] = True
+        
+        # breadth-first pass to build the failure links
+        queue = list(self.goto[0].values())
+        while queue:
+            state = queue.pop(0)
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fail = self.fail[state]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[next_state] = self.goto[fail].get(char, 0)
+                if self.output[self.fail[next_state]]:
+                    self.output[next_state] = True
+    
+    def search(self, text):
+        goto, fail, output = self.goto, self.fail, self.output
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state]:
+                return True
+        return False
+
+
+class KeywordMatcher(object):
+    """
+    Case-insensitive test for whether a piece of text contains any one of a
+    set of keywords
+    """
+    def __init__(self, keywords):
+        self.keywords = keywords
+        if len(keywords) > AHO_CORASICK_THRESHOLD:
+            self._search = AhoCorasick(keywords).search
+        else:
+            self._search = re.compile('|'.join([re.escape(k) for k in keywords]),
+                                      re.IGNORECASE | re.UNICODE).search
+    
+    def matches(self, text):
+        return bool(self._search(smart_unicode(text).lower()))
+
+
+_matchers = {}
+
+def get_matcher(keywords):
+    """
+    Return a compiled matcher for a tuple of keywords, or None if there are no
+    keywords (in which case everything passes)
+    """
+    if not keywords:
+        return None
+    if keywords not in _matchers:
+        _matchers[keywords] = KeywordMatcher(keywords)
+    return _matchers[keywords]
+
+
+class WhiteLists(object):
+    """
+    Every feed -> category and category -> category relationship along with
+    its compiled whitelist, loaded in a handful of queries.  An article passes
+    a relationship if the relationship has no keywords or the headline
+    contains at least one of them.
+    """
+    def __init__(self):
+        from news.models import WhiteListFilter, FeedCategoryRelationship, \
+            CategoryRelationship
+        
+        keywords = dict(WhiteListFilter.objects.values_list('id', 'keywords'))
+        
+        # feed id -> list of (category id, [matchers]), one matcher for each
+        # relationship between the feed and category
+        self.feed_rules = {}
+        feed_keywords = self.load_keywords(FeedCategoryRelationship, keywords)
+        by_category = {}
+        for pk, feed_id, category_id in FeedCategoryRelationship.objects.values_list(
+            'id', 'feed', 'category').order_by('id'):
+            key = (feed_id, category_id)
+            if key not in by_category:
+                by_category[key] = []
+                self.feed_rules.setdefault(feed_id, []).append(
+                    (category_id, by_category[key]))
+            by_category[key].append(get_matcher(feed_keywords.get(pk)))
+        
+        # included category id -> list of (including category id, matcher)
+        self.category_rules = {}
+        category_keywords = self.load_keywords(CategoryRelationship, keywords)
+        for pk, category_id, included_id in CategoryRelationship.objects.values_list(
+            'id', 'category', 'included_category').order_by('id'):
+            self.category_rules.setdefault(included_id, []).append(
+                (category_id, get_matcher(category_keywords.get(pk))))
+        self.graph = CategoryGraph(self.category_rules)
+        
+        self.loaded = time.time()
+    
+    def load_keywords(self, model, keywords):
+        # map each relationship to the keywords of all its whitelists
+        keyword_lists = {}
+        for pk, white_list_id in m2m_pairs(model, 'white_list'):
+            keyword_lists.setdefault(pk, []).append(keywords.get(white_list_id, ''))
+        return dict([(pk, parse_keywords(lists)) for pk, lists in keyword_lists.items()])
+    
+    def feed_categories(self, feed_id, headline):
+        """
+        Ids of the categories a feed's article can go into, based on the
+        whitelists of the feed's category relationships
+        """
+        categories = []
+        for category_id, matchers in self.feed_rules.get(feed_id, ()):
+            for matcher in matchers:
+                if matcher and not matcher.matches(headline):
+                    break
+            else:
+                categories.append(category_id)
+        return categories
+    
+    def route(self, feed_id, headline):
+        """
+        Ids of every category a feed's article goes into - the feed's own
+        categories plus all the categories that include them
+        """
+        categories = self.feed_categories(feed_id, headline)
+        if not categories:
+            return []
+        return list(self.graph.resolve(categories, headline))
+
+
+_whitelists = None
+_whitelists_lock = threading.Lock()
+
+def get_whitelists():
+    """
+    Return the cached WhiteLists, loading them if they have been invalidated
+    or have expired
+    """
+    global _whitelists
+    _whitelists_lock.acquire()
+    try:
+        if _whitelists is None or \
+           time.time() - _whitelists.loaded > WHITELIST_CACHE_TIMEOUT:
+            _whitelists = WhiteLists()
+        return _whitelists
+    finally:
+        _whitelists_lock.release()
+
+def clear_whitelists(*args, **kwargs):
+    """
+    Throw away the cached whitelists - connected to the save and delete
+    signals of every model they are built from
+    """
+    global _whitelists
+    _whitelists = None
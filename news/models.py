@@ -1,19 +1,68 @@
 import time
 import datetime
-import feedparser
+import gzip
+import os
 import re
+import socket
+import urllib2
 
 from django.conf import settings
-from django.db import models
+from django.db import connection, models, transaction
+from django.db.models import signals
+from django.utils import simplejson
+from django.utils.encoding import smart_str
 
-# blocked html takes a list of tag names, i.e. ['script', 'img', 'embed']
-BLOCKED_HTML = getattr(settings, 'NEWS_BLOCKED_HTML', [])
-BLOCKED_REGEX = re.compile(r'<(%s)[^>]*(/>|.*?</\1>)' % ('|'.join(BLOCKED_HTML)), 
-                           re.DOTALL | re.IGNORECASE)
+from news.cache import invalidate_articles, invalidate_categories, \
+    invalidate_category_list
+from news.clustering import CLUSTER_DAYS, CLUSTER_DISTANCE, \
+    CLUSTER_DUPLICATES, article_simhash, band_keys, distance
+from news.fetcher import fetch_parsed
+from news.instrumentation import IngestStats
+from news.matching import get_whitelists, clear_whitelists
+from news.scheduling import MIN_DOWNLOAD_INTERVAL, schedule_download
+from news.sanitize import sanitize
+from news.search import get_search_backend
+from news.streaming import fetch_stream
+from news.utils import chunked, delete_related_rows, fingerprint, \
+    headline_key, insert_instances, insert_rows, make_teaser
 
 # number of days after which articles should be marked expired
 EXPIRE_ARTICLES = getattr(settings, 'EXPIRE_ARTICLES', True)
-EXPIRE_ARTICLES_DAYS = getattr(settings, 'EXPIRE_ARTICLES', 7)
+EXPIRE_ARTICLES_DAYS = getattr(settings, 'EXPIRE_ARTICLES_DAYS', 7)
+
+# number of days after which articles are deleted outright - articles are
+# never deleted if this is not set
+PURGE_ARTICLES_DAYS = getattr(settings, 'NEWS_PURGE_ARTICLES_DAYS', None)
+
+# number of articles deleted per transaction when purging
+PURGE_BATCH_SIZE = getattr(settings, 'NEWS_PURGE_BATCH_SIZE', 500)
+
+# directory that purged articles are exported to, as gzipped JSON lines
+PURGE_EXPORT_DIR = getattr(settings, 'NEWS_PURGE_EXPORT_DIR', None)
+
+# maximum number of values to put in a single IN clause
+LOOKUP_BATCH_SIZE = getattr(settings, 'NEWS_LOOKUP_BATCH_SIZE', 500)
+
+# length of the teasers shown in article listings, in words and at most in
+# characters
+TEASER_WORDS = getattr(settings, 'NEWS_TEASER_WORDS', 50)
+TEASER_MAX_LENGTH = getattr(settings, 'NEWS_TEASER_MAX_LENGTH', 1000)
+
+# number of entries parsed at a time from feeds marked for streaming
+STREAMING_BATCH_SIZE = getattr(settings, 'NEWS_STREAMING_BATCH_SIZE', 100)
+
+def download_error(data):
+    """
+    Whether a download failed - feedparser does not raise when the server
+    cannot be reached, it returns a result with no status and the exception
+    in bozo_exception
+    """
+    if data is None:
+        return True
+    if data.get('status') is not None:
+        return data.get('status') >= 400
+    return isinstance(data.get('bozo_exception'),
+                      (urllib2.URLError, socket.error, IOError))
 
 class Source(models.Model):
     """
@@ -40,6 +89,56 @@ class WhiteListFilter(models.Model):
     def __unicode__(self):
         return u'%s' % self.name
 
+class CategoryManager(models.Manager):
+    def add_articles(self, articles):
+        """
+        Update the article counts and latest publish dates of the categories
+        that a batch of new articles went into.  Takes a list of (article,
+        category ids) 2-tuples.
+        """
+        counts, latest = {}, {}
+        for article, category_ids in articles:
+            for category_id in category_ids:
+                counts[category_id] = counts.get(category_id, 0) + 1
+                if category_id not in latest or article.publish > latest[category_id]:
+                    latest[category_id] = article.publish
+        self.adjust_counts(counts)
+        
+        by_date = {}
+        for category_id, publish in latest.items():
+            by_date.setdefault(publish, []).append(category_id)
+        for publish, category_ids in by_date.items():
+            for chunk in chunked(category_ids, LOOKUP_BATCH_SIZE):
+                self.filter(pk__in=chunk).filter(
+                    models.Q(latest_publish__lt=publish) |
+                    models.Q(latest_publish__isnull=True)).update(
+                    latest_publish=publish)
+    
+    def remove_articles(self, **filters):
+        """
+        Take the unexpired articles matching the given filters, i.e.
+        ``date_added__lt=some_date``, out of the article counts
+        """
+        lookups = dict([('articles__%s' % k, v) for k, v in filters.items()])
+        counts = self.filter(articles__expired=False, **lookups).annotate(
+            num_articles=models.Count('articles')).values_list(
+            'id', 'num_articles')
+        self.adjust_counts(dict([(pk, -n) for pk, n in counts]))
+    
+    def adjust_counts(self, counts):
+        """
+        Apply a dictionary of category pk -> change in article count, with one
+        UPDATE for every distinct change
+        """
+        by_change = {}
+        for category_id, change in counts.items():
+            if change:
+                by_change.setdefault(change, []).append(category_id)
+        for change, category_ids in by_change.items():
+            for chunk in chunked(category_ids, LOOKUP_BATCH_SIZE):
+                self.filter(pk__in=chunk).update(
+                    article_count=models.F('article_count') + change)
+
 class Category(models.Model):
     """
     Categories are populated by collections of feeds and/or other categories.
@@ -64,6 +163,13 @@ class Category(models.Model):
     url_path = models.CharField(max_length=255, editable=False, db_index=True)
     level = models.IntegerField(default=0, editable=False)
     
+    # cached fields, updated as articles are added and expired - see the
+    # rebuild_category_counts command
+    article_count = models.IntegerField(default=0, editable=False)
+    latest_publish = models.DateTimeField(null=True, blank=True, editable=False)
+    
+    objects = CategoryManager()
+    
     class Meta:
         verbose_name_plural = 'categories'
         ordering = ('url_path',)
@@ -71,6 +177,13 @@ class Category(models.Model):
     def __unicode__(self):
         return u'%s' % self.url_path
     
+    def __init__(self, *args, **kwargs):
+        super(Category, self).__init__(*args, **kwargs)
+        # remember where the category was loaded from, so a save can tell
+        # whether its subtree needs to move
+        self._saved_url_path = self.url_path
+        self._saved_level = self.level
+    
     def save(self, *args, **kwargs):
         if self.parent:
             # denormalize a path to this category and store its depth
@@ -85,13 +198,41 @@ class Category(models.Model):
         super(Category, self).save(*args, **kwargs)
         
         # update all subcategories in case the url_path changed
-        if self.children:
-            def update_children(children):
-                for child in children:
-                    child.save()
-                    if child.children:
-                        update_children(child.children.all())
-            update_children(self.children.all())
+        if self._saved_url_path and (self._saved_url_path != self.url_path or
+                                     self._saved_level != self.level):
+            self.move_descendants(self._saved_url_path, self._saved_level)
+        
+        self._saved_url_path = self.url_path
+        self._saved_level = self.level
+    
+    def move_descendants(self, old_url_path, old_level):
+        """
+        Rewrite the url_path and level of every category below this one after
+        it has moved from old_url_path, using a single UPDATE that swaps the
+        path prefix
+        """
+        qn = connection.ops.quote_name
+        if settings.DATABASE_ENGINE.startswith('mysql'):
+            new_path = 'CONCAT(%s, SUBSTRING(%s, %%s))'
+        else:
+            new_path = '(%s || SUBSTR(%s, %%s))'
+        new_path = new_path % ('%s', qn('url_path'))
+        
+        sql = 'UPDATE %s SET %s = %s, %s = %s + %%s WHERE %s %s AND %s <> %%s' % (
+            qn(self._meta.db_table),
+            qn('url_path'), new_path,
+            qn('level'), qn('level'),
+            qn('url_path'), connection.operators['startswith'] % '%s',
+            qn(self._meta.pk.column))
+        params = [
+            self.url_path, len(old_url_path) + 1,
+            self.level - old_level,
+            connection.ops.prep_for_like_query(old_url_path) + '%',
+            self.pk]
+        
+        cursor = connection.cursor()
+        cursor.execute(sql, params)
+        transaction.commit_unless_managed()
 
     @models.permalink
     def get_absolute_url(self):
@@ -127,6 +268,28 @@ class Feed(models.Model):
     new_articles_added = models.PositiveSmallIntegerField(default=0, 
         editable=False)
     active = models.BooleanField(default=True)
+    streaming = models.BooleanField(default=False, help_text="Parse the feed "
+        "incrementally, stopping at the first batch of entries that have "
+        "already been downloaded.  For very large feeds.")
+    
+    # HTTP validators from the last download, sent back on the next request
+    # so that unchanged feeds can be answered with a 304
+    etag = models.CharField(max_length=255, blank=True, editable=False)
+    last_modified = models.CharField(max_length=64, blank=True, editable=False)
+    
+    # when the feed is next due to be downloaded, adjusted after each download
+    # according to how often it publishes and whether it is failing
+    next_download = models.DateTimeField(null=True, blank=True, editable=False,
+        db_index=True)
+    download_interval = models.PositiveIntegerField(
+        default=MIN_DOWNLOAD_INTERVAL, editable=False)
+    download_errors = models.PositiveSmallIntegerField(default=0, editable=False)
+    
+    # the worker currently processing the feed, when feeds are shared out
+    # between several processes
+    lease_owner = models.CharField(max_length=255, blank=True, editable=False)
+    lease_expires = models.DateTimeField(null=True, blank=True, editable=False,
+        db_index=True)
     
     class Meta:
         ordering = ('name',)
@@ -134,17 +297,109 @@ class Feed(models.Model):
     def __unicode__(self):
         return u'%s - %s' % (self.source.name, self.name)
     
-    def download_feed(self):
+    def update_validators(self, data):
+        """
+        Remember the ETag and Last-Modified headers returned with the feed
+        """
+        self.etag = data.get('etag', '') or ''
+        modified = data.get('modified', '') or ''
+        if not isinstance(modified, basestring):
+            # older versions of feedparser hand back a parsed time tuple
+            modified = time.strftime('%a, %d %b %Y %H:%M:%S GMT', modified)
+        self.last_modified = modified
+    
+    def fetch_feed(self, deadline=None):
+        """
+        Download and parse the feed, returning the feedparser result or None
+        if the download failed or was still going when time.time() passed
+        ``deadline``.  Does not touch the database, so it is safe to call
+        from a worker thread.
+        """
         try:
-            # download the feed data
-            data = feedparser.parse(self.url)
+            if self.streaming:
+                return fetch_stream(self.url, etag=self.etag or None,
+                                    modified=self.last_modified or None,
+                                    deadline=deadline)
+            return fetch_parsed(self.url, etag=self.etag or None,
+                                modified=self.last_modified or None,
+                                deadline=deadline)
         except:
+            return None
+    
+    def download_failed(self):
+        """
+        Record a failed download, backing off before the next attempt
+        """
+        schedule_download(self, error=True)
+        self.save()
+    
+    def download_feed(self, data=None, stats=None):
+        """
+        Download the feed, or process data already fetched with fetch_feed(),
+        adding new articles to the feed's categories.  Pass an IngestStats to
+        collect timings for each stage.
+        """
+        if stats is None:
+            stats = IngestStats(self.url)
+        
+        if data is None:
+            # download the feed data
+            data = self.fetch_feed()
+            stats.lap('fetch')
+        if download_error(data):
+            self.download_failed()
             return False
         
+        if data.get('status') == 304:
+            # the feed has not changed since the last download, so there is
+            # nothing to parse
+            self.new_articles_added = 0
+            schedule_download(self)
+            self.save()
+            stats.lap('save')
+            return
+        
+        self.update_validators(data)
+        
+        # entries are processed in batches when the feed is being streamed,
+        # so the rest of the feed can be skipped once a batch turns out to
+        # have been seen before.  entries turned away by the white-lists are
+        # never recorded, so a batch counts as seen when it adds nothing and
+        # has at least one known entry
+        if getattr(data, 'streaming', False):
+            batches = chunked(data.entries, STREAMING_BATCH_SIZE)
+        else:
+            batches = [data.entries]
+        
         new_articles_added = 0
+        publish_dates = []
+        for batch in batches:
+            num_new, num_known, dates = self.process_entries(data, batch, stats)
+            new_articles_added += num_new
+            publish_dates.extend(dates)
+            if getattr(data, 'streaming', False) and not num_new and num_known:
+                break
         
-        # iterate over the entries returned by the feed
-        for entry in data.entries:
+        if getattr(data, 'streaming', False):
+            data.close()
+        
+        self.new_articles_added = new_articles_added
+        self.last_downloaded = datetime.datetime.now()
+        schedule_download(self, new_articles_added, publish_dates)
+        self.save()
+        stats.new_articles = new_articles_added
+        stats.lap('save')
+    
+    def process_entries(self, data, batch, stats):
+        """
+        Add articles for a batch of the feed's entries, returning the number
+        of new articles, the number of entries that were already known and
+        the entries' parsed publish dates
+        """
+        # clean up the data for every entry first, so that the articles we
+        # already have can be looked up in a couple of queries
+        entries = []
+        for entry in batch:
             # remove all HTML from the title and clean up the data
             entry.title = re.sub('<[^>]*>', '', entry.title)
             headline = entry.title.encode(data.encoding, "xmlcharrefreplace")
@@ -154,107 +409,127 @@ class Feed(models.Model):
             if not guid:
                 guid = url
             
+            entries.append((entry, headline, headline_key(headline), guid, url))
+        
+        stats.entries += len(entries)
+        stats.lap('prepare')
+        
+        known_guids, known_headlines = Article.objects.lookup_existing(self,
+            [e[3] for e in entries], [e[2] for e in entries])
+        stats.lap('lookup')
+        
+        # compiled whitelists for every feed and category relationship
+        whitelists = get_whitelists()
+        
+        # new articles and the categories they are going into, inserted in
+        # bulk once every entry has been looked at
+        new_articles = []
+        
+        # iterate over the entries returned by the feed
+        num_known = 0
+        for entry, headline, key, guid, url in entries:
+            if guid in known_guids or key in known_headlines:
+                # articles are only categorized when they first come in
+                num_known += 1
+                continue
+            
+            if hasattr(entry, "summary"):
+                content = entry.summary
+            elif hasattr(entry, "content"):
+                content = entry.content[0].value
+            elif hasattr(entry, "description"):
+                content = entry.description
+            else:
+                content = u""
+            content = content.encode(data.encoding, "xmlcharrefreplace")
+            
             try:
-                article = Article.objects.get(
-                    models.Q(guid=guid, feed=self) |
-                    models.Q(headline__iexact=headline))
-            except Article.DoesNotExist:
-                if hasattr(entry, "summary"):
-                    content = entry.summary
-                elif hasattr(entry, "content"):
-                    content = entry.content[0].value
-                elif hasattr(entry, "description"):
-                    content = entry.description
-                else:
-                    content = u""
-                content = content.encode(data.encoding, "xmlcharrefreplace")
+                pubdate = None
+                attrs = ['updated_parsed', 'published_parsed', 'date_parsed', 'created_parsed']
+                for attr in attrs:
+                    if hasattr(entry, attr):
+                        pubdate = getattr(entry, attr)
+                        break
                 
-                try:
-                    pubdate = None
-                    attrs = ['updated_parsed', 'published_parsed', 'date_parsed', 'created_parsed']
-                    for attr in attrs:
-                        if hasattr(entry, attr):
-                            pubdate = getattr(entry, attr)
-                            break
-                    
-                    if not pubdate:
-                        if data.feed.has_key('updated_parsed'):
-                            pubdate = data.feed.updated_parsed
-                        elif data.feed.has_key('updated'):
-                            pubdate = data.feed.updated
-                    
-                    if pubdate:
-                        date_modified = datetime.datetime.fromtimestamp(time.mktime(pubdate))
-                    else:
-                        date_modified = datetime.datetime.now()
-                except TypeError:
-                    date_modified = datetime.datetime.now()
+                if not pubdate:
+                    if data.feed.has_key('updated_parsed'):
+                        pubdate = data.feed.updated_parsed
+                    elif data.feed.has_key('updated'):
+                        pubdate = data.feed.updated
                 
-                # note: the article is not getting saved yet - only save those
-                # articles that will go into at least one category
-                article = Article(
-                    feed=self,
-                    headline=headline, 
-                    url=url, 
-                    content=content, 
-                    guid=guid, 
-                    publish=date_modified
-                )
+                if pubdate:
+                    date_modified = datetime.datetime.fromtimestamp(time.mktime(pubdate))
+                else:
+                    date_modified = datetime.datetime.now()
+            except TypeError:
+                date_modified = datetime.datetime.now()
             
-            # what categories will this article get added to?    
-            add_to_categories = []
+            # note: the article is not getting saved yet - only save those
+            # articles that will go into at least one category
+            article = Article(
+                feed=self,
+                headline=headline, 
+                headline_key=key,
+                url=url, 
+                content=content, 
+                guid=guid, 
+                publish=date_modified
+            )
             
-            # iterate over the categories associated with this feed
-            for category in self.categories.all():
-                relationship_queryset = FeedCategoryRelationship.objects.filter(
-                    feed=self, category=category)
-                article_passes = True
-                
-                for relationship in relationship_queryset.all():
-                    whitelist = []
-                    for white_list in relationship.white_list.all():
-                        whitelist += white_list.keywords.split(',')
-                    
-                    if whitelist:
-                        if not re.search(re.compile(r'(%s)' % '|'.join([s.strip() for s in whitelist if s.strip()]), re.IGNORECASE), article.headline):
-                            article_passes = False
-                            break
-                    
-                    if BLOCKED_HTML:
-                        article.content = re.sub(BLOCKED_REGEX, '', article.content)
-                    
-                if article_passes:
-                    add_to_categories.append(category)
+            # what categories will this article get added to?  this covers
+            # the feed's own categories and any other categories that include
+            # them, as long as the article passes their white-lists
+            add_to_categories = whitelists.route(self.pk, article.headline)
             
             if len(add_to_categories) > 0:
-                if not article.pk:
-                    new_articles_added += 1
-                article.save()
-                
-                # now check the categories we're adding the article to, and see
-                # if any other categories include them - if so, make sure the
-                # article passes any white-lists and add the article to the
-                # included categories as well
-                for category in add_to_categories:
-                    for category_relationship in CategoryRelationship.objects.filter(included_category=category):
-                        article_passes = True
-                        whitelist = []
-                        for white_list in category_relationship.white_list.all():
-                            whitelist += white_list.keywords.split(',')
-                        
-                        if whitelist:
-                            if not re.search(re.compile(r'(%s)' % '|'.join([s.strip() for s in whitelist if s.strip()]), re.IGNORECASE), article.headline):
-                                article_passes = False
-                                break
-                        
-                        add_to_categories.append(category_relationship.category)
+                # strip blocked html once, now that the article is going in
+                article.content = sanitize(article.content)
+                text = article.content.decode(data.encoding, 'replace')
+                article.teaser = make_teaser(text, TEASER_WORDS,
+                                             TEASER_MAX_LENGTH)
+                new_articles.append((article, add_to_categories))
                 
-                article.categories = add_to_categories
-                article.save()
+                # catch entries repeated later on in the same feed
+                known_guids[guid] = known_headlines[key] = None
         
-        self.new_articles_added = new_articles_added
-        self.last_downloaded = datetime.datetime.now()
-        self.save()
+        stats.lap('route')
+        
+        if CLUSTER_DUPLICATES:
+            for article, _ in new_articles:
+                article.simhash = article_simhash(article.headline,
+                    article.content.decode(data.encoding, 'replace'))
+            stats.lap('cluster')
+        
+        self.store_articles(new_articles, stats)
+        
+        if new_articles:
+            category_ids = set()
+            for article, categories in new_articles:
+                category_ids.update(categories)
+            invalidate_categories(Category.objects.filter(
+                pk__in=category_ids).values_list('url_path', flat=True))
+            invalidate_category_list()
+        
+        return len(new_articles), num_known, [
+            entry.get('updated_parsed', entry.get('published_parsed')) 
+            for entry, _, _, _, _ in entries]
+    
+    @transaction.commit_on_success
+    def store_articles(self, new_articles, stats):
+        """
+        Insert a batch of new articles along with their categories, search
+        terms, clusters and category counts, committing them all at once so
+        that no article is left without its categories
+        """
+        Article.objects.create_in_bulk(self, new_articles)
+        stats.lap('insert')
+        get_search_backend().index([article for article, _ in new_articles])
+        stats.lap('index')
+        if CLUSTER_DUPLICATES:
+            Article.objects.cluster_articles(new_articles)
+            stats.lap('cluster')
+        if new_articles:
+            Category.objects.add_articles(new_articles)
 
 class FeedCategoryRelationship(models.Model):
     feed = models.ForeignKey(Feed)
@@ -263,13 +538,302 @@ class FeedCategoryRelationship(models.Model):
 
 
 class ArticleManager(models.Manager):
+    def listed(self, category=None, include_subcategories=False):
+        """
+        The unexpired articles shown for a category, or for every category
+        if none is given
+        """
+        if category is None:
+            qs = self.filter(expired=False)
+        elif include_subcategories:
+            # every category in the subtree shares the url_path prefix, so a
+            # single join picks up articles filed anywhere below this one
+            qs = self.filter(expired=False,
+                categories__url_path__startswith=category.url_path).distinct()
+        else:
+            qs = category.articles.filter(expired=False)
+        if CLUSTER_DUPLICATES:
+            # show a story once - duplicates are only flagged when the
+            # cluster's first article is filed everywhere they are
+            qs = qs.filter(duplicate=False)
+        return qs
+    
+    def lookup_existing(self, feed, guids, headline_keys):
+        """
+        Find the articles that already exist for a batch of feed entries.
+        Returns two dictionaries, one mapping guids to the pks of the feed's
+        articles and one mapping headline keys to the pks of articles from
+        any feed.  Articles that have been purged are included with a pk of
+        None.
+        """
+        by_guid, by_headline = {}, {}
+        for chunk in chunked(set(guids), LOOKUP_BATCH_SIZE):
+            for guid, pk in self.filter(feed=feed, guid__in=chunk).values_list(
+                'guid', 'id'):
+                by_guid[smart_str(guid)] = pk
+        for chunk in chunked(set(headline_keys), LOOKUP_BATCH_SIZE):
+            for key, pk in self.filter(headline_key__in=chunk).values_list(
+                'headline_key', 'id'):
+                by_headline[key] = pk
+        
+        guid_keys = dict([(fingerprint(guid), guid) for guid in guids])
+        for chunk in chunked(guid_keys.keys(), LOOKUP_BATCH_SIZE):
+            for key in ArticleFingerprint.objects.filter(feed=feed,
+                guid_key__in=chunk).values_list('guid_key', flat=True):
+                by_guid.setdefault(guid_keys[key], None)
+        for chunk in chunked(set(headline_keys), LOOKUP_BATCH_SIZE):
+            for key in ArticleFingerprint.objects.filter(
+                headline_key__in=chunk).values_list('headline_key', flat=True):
+                by_headline.setdefault(key, None)
+        return by_guid, by_headline
+    
+    def create_in_bulk(self, feed, articles):
+        """
+        Insert a feed's new articles and their category links with a handful
+        of multi-row INSERTs.  Takes a list of (article, category ids)
+        2-tuples and sets the primary key on each article.  Article.save() is
+        not called, so no signals are sent.
+        """
+        if not articles:
+            return
+        
+        insert_instances(self.model, [article for article, _ in articles])
+        
+        # guids are unique within the feed for new articles, so they can be
+        # used to read back the primary keys
+        pks = {}
+        guids = [article.guid for article, _ in articles]
+        for chunk in chunked(guids, LOOKUP_BATCH_SIZE):
+            for guid, pk in self.filter(feed=feed, guid__in=chunk).values_list(
+                'guid', 'id'):
+                pks[smart_str(guid)] = pk
+        
+        links = set()
+        for article, category_ids in articles:
+            article.pk = pks[smart_str(article.guid)]
+            for category_id in category_ids:
+                links.add((article.pk, category_id))
+        
+        field = self.model._meta.get_field('categories')
+        insert_rows(field.m2m_db_table(),
+            [field.m2m_column_name(), field.m2m_reverse_name()], list(links))
+    
+    def cluster_articles(self, articles):
+        """
+        File newly inserted articles into clusters with the recent articles
+        whose fingerprints are within CLUSTER_DISTANCE bits of theirs, and
+        add them to the index used to find candidates.  Takes a list of
+        (article, category ids) 2-tuples.  Every article in a cluster points
+        at the cluster's first article, and is flagged as a duplicate when
+        that article is filed in all of its categories - so wherever the
+        duplicate is listed, the first article is listed too.
+        """
+        articles = [(article, category_ids) for article, category_ids in articles
+                    if article.simhash]
+        if not articles:
+            return
+        
+        # the fingerprints of recent articles sharing a band with any of the
+        # new ones, keyed by band
+        keys = set()
+        for article, _ in articles:
+            keys.update(band_keys(article.simhash))
+        since = datetime.datetime.now() - datetime.timedelta(days=CLUSTER_DAYS)
+        candidates = {}
+        for chunk in chunked(keys, LOOKUP_BATCH_SIZE):
+            for key, pk, simhash, cluster_id in ArticleBand.objects.filter(
+                key__in=chunk, date_added__gte=since).values_list('key', 
+                'article', 'article__simhash', 'article__cluster'):
+                candidates.setdefault(key, []).append((pk, simhash, cluster_id or pk))
+        
+        matches = []
+        head_categories = {}
+        rows = []
+        now = datetime.datetime.now()
+        for article, category_ids in articles:
+            keys = band_keys(article.simhash)
+            best = None
+            for key in keys:
+                for pk, simhash, head in candidates.get(key, []):
+                    bits = distance(article.simhash, simhash)
+                    if bits <= CLUSTER_DISTANCE and (best is None or bits < best[0]):
+                        best = (bits, head)
+            
+            head = article.pk
+            if best is not None:
+                head = article.cluster_id = best[1]
+                matches.append((article, category_ids))
+            else:
+                head_categories[article.pk] = set(category_ids)
+            
+            # later articles in the batch can join this one's cluster
+            for key in keys:
+                rows.append((article.pk, key, now))
+                candidates.setdefault(key, []).append((article.pk, article.simhash, head))
+        
+        missing = set([article.cluster_id for article, _ in matches]).difference(
+            head_categories)
+        for pk, category_ids in self.article_categories(missing).items():
+            head_categories[pk] = set(category_ids)
+        
+        clusters = {}
+        for article, category_ids in matches:
+            article.duplicate = set(category_ids).issubset(
+                head_categories.get(article.cluster_id, ()))
+            clusters.setdefault((article.cluster_id, article.duplicate), []).append(
+                article.pk)
+        for (head, duplicate), pks in clusters.items():
+            for chunk in chunked(pks, LOOKUP_BATCH_SIZE):
+                self.filter(pk__in=chunk).update(cluster=head, duplicate=duplicate)
+        insert_rows(ArticleBand._meta.db_table, ['article_id', 'key', 'date_added'],
+                    rows)
+    
+    def article_categories(self, pks):
+        """
+        Read the category ids of a set of articles straight from the join
+        table, returning a dictionary of article pk -> list of category ids
+        """
+        qn = connection.ops.quote_name
+        field = self.model._meta.get_field('categories')
+        categories = {}
+        for chunk in chunked(list(pks), LOOKUP_BATCH_SIZE):
+            cursor = connection.cursor()
+            cursor.execute('SELECT %s, %s FROM %s WHERE %s IN (%s)' % (
+                qn(field.m2m_column_name()), qn(field.m2m_reverse_name()),
+                qn(field.m2m_db_table()), qn(field.m2m_column_name()),
+                ', '.join(['%s'] * len(chunk))), chunk)
+            for article_id, category_id in cursor.fetchall():
+                categories.setdefault(article_id, []).append(category_id)
+        return categories
+    
+    def prune_clusters(self):
+        """
+        Drop the fingerprints of articles too old to start a cluster from
+        the index, keeping its buckets small
+        """
+        if not CLUSTER_DUPLICATES:
+            return
+        since = datetime.datetime.now() - datetime.timedelta(days=CLUSTER_DAYS)
+        cursor = connection.cursor()
+        cursor.execute('DELETE FROM %s WHERE %s < %%s' % (
+            connection.ops.quote_name(ArticleBand._meta.db_table),
+            connection.ops.quote_name('date_added')),
+            [since])
+        transaction.commit_unless_managed()
+    
     def expire_articles(self):
         if EXPIRE_ARTICLES:
             expire_date = datetime.datetime.now() - datetime.timedelta(
                 days=EXPIRE_ARTICLES_DAYS)
-            num_expired = self.filter(date_added__lt=expire_date).update(
-                expired=True)
+            num_expired = self.expire_before(expire_date)
+            if num_expired:
+                invalidate_articles()
+                invalidate_category_list()
             return num_expired
+    
+    @transaction.commit_on_success
+    def expire_before(self, expire_date):
+        """
+        Mark the articles added before a date expired, taking them out of the
+        category counts in the same commit
+        """
+        Category.objects.remove_articles(date_added__lt=expire_date)
+        num_expired = self.filter(expired=False,
+            date_added__lt=expire_date).update(expired=True)
+        # duplicates outlive the first article of their cluster, so list
+        # them again once it is gone
+        self.filter(duplicate=True, cluster__expired=True).update(duplicate=False)
+        return num_expired
+    
+    def purge_articles(self):
+        """
+        Delete articles added more than PURGE_ARTICLES_DAYS ago, committing
+        after every PURGE_BATCH_SIZE articles so locks are only held briefly.
+        A fingerprint of each article is kept so that it is not downloaded
+        again, and the articles are written to PURGE_EXPORT_DIR first if it
+        is set.  Returns the number of articles purged.
+        """
+        if not PURGE_ARTICLES_DAYS:
+            return 0
+        
+        purge_date = datetime.datetime.now() - datetime.timedelta(
+            days=PURGE_ARTICLES_DAYS)
+        qs = self.filter(date_added__lt=purge_date).order_by('pk')
+        
+        export = None
+        if PURGE_EXPORT_DIR:
+            export = gzip.open(os.path.join(PURGE_EXPORT_DIR, 'articles-%s.json.gz' % 
+                purge_date.strftime('%Y%m%d%H%M%S')), 'ab')
+        
+        num_purged = 0
+        try:
+            while True:
+                if export:
+                    batch = list(qs[:PURGE_BATCH_SIZE])
+                    self.export_articles(batch, export)
+                    rows = [(a.pk, a.feed_id, a.guid, a.headline_key) for a in batch]
+                else:
+                    rows = list(qs.values_list('id', 'feed', 'guid', 
+                        'headline_key')[:PURGE_BATCH_SIZE])
+                if not rows:
+                    break
+                
+                self.purge_batch(rows)
+                num_purged += len(rows)
+        finally:
+            if export:
+                export.close()
+        
+        if num_purged:
+            invalidate_articles()
+            invalidate_category_list()
+        return num_purged
+    
+    @transaction.commit_on_success
+    def purge_batch(self, rows):
+        """
+        Delete a batch of articles, given as (pk, feed id, guid, headline key)
+        4-tuples, in a single transaction - their fingerprints are stored and
+        they are taken out of the category counts in the same commit
+        """
+        pks = [row[0] for row in rows]
+        Category.objects.remove_articles(pk__in=pks)
+        self.filter(duplicate=True, cluster__in=pks).update(duplicate=False)
+        now = datetime.datetime.now()
+        insert_rows(ArticleFingerprint._meta.db_table,
+            ['feed_id', 'guid_key', 'headline_key', 'date_added'],
+            [(feed_id, fingerprint(guid), key, now) for 
+             pk, feed_id, guid, key in rows])
+        
+        # delete with plain SQL, the ORM would look up the related
+        # rows of every article one at a time
+        delete_related_rows(self.model, pks)
+        cursor = connection.cursor()
+        cursor.execute('DELETE FROM %s WHERE %s IN (%s)' % (
+            connection.ops.quote_name(self.model._meta.db_table),
+            connection.ops.quote_name(self.model._meta.pk.column),
+            ', '.join(['%s'] * len(pks))), pks)
+    
+    def export_articles(self, articles, fh):
+        """
+        Write articles to a file as JSON, one article per line
+        """
+        categories = self.article_categories([article.pk for article in articles])
+        
+        for article in articles:
+            fh.write(simplejson.dumps({
+                'id': article.pk,
+                'feed': article.feed_id,
+                'headline': article.headline,
+                'url': article.url,
+                'guid': article.guid,
+                'content': article.content,
+                'publish': article.publish.isoformat(),
+                'date_added': article.date_added.isoformat(),
+                'expired': article.expired,
+                'categories': categories.get(article.pk, []),
+            }))
+            fh.write('\n')
 
 class Article(models.Model):
     headline = models.CharField(max_length=255)
@@ -277,7 +841,15 @@ class Article(models.Model):
     publish = models.DateTimeField(default=datetime.datetime.now)
     url = models.URLField()
     content = models.TextField()
-    guid = models.CharField(max_length=255, blank=True, editable=False)
+    teaser = models.TextField(blank=True, editable=False)
+    guid = models.CharField(max_length=255, blank=True, editable=False,
+        db_index=True)
+    headline_key = models.CharField(max_length=40, editable=False,
+        db_index=True)
+    simhash = models.CharField(max_length=16, blank=True, editable=False)
+    cluster = models.ForeignKey('self', null=True, blank=True, editable=False,
+        related_name='duplicates')
+    duplicate = models.BooleanField(default=False, editable=False, db_index=True)
     date_added = models.DateTimeField(auto_now_add=True)
     expired = models.BooleanField(default=False)
     
@@ -292,5 +864,65 @@ class Article(models.Model):
     def __unicode__(self):
         return u'%s' % self.headline
     
+    def save(self, *args, **kwargs):
+        self.headline_key = headline_key(self.headline)
+        self.teaser = make_teaser(self.content, TEASER_WORDS, TEASER_MAX_LENGTH)
+        super(Article, self).save(*args, **kwargs)
+    
     def get_absolute_url(self):
         return self.url
+
+class Lock(models.Model):
+    """
+    A named lock shared by every process using the database, see
+    news.locks.DatabaseLock
+    """
+    name = models.CharField(max_length=100, unique=True)
+    owner = models.CharField(max_length=255)
+    acquired = models.DateTimeField()
+    heartbeat = models.DateTimeField()
+    
+    def __unicode__(self):
+        return u'%s' % self.name
+
+class ArticleFingerprint(models.Model):
+    """
+    What is left of an article once it has been purged - digests of its guid
+    and headline, so that the article is not downloaded again
+    """
+    feed = models.ForeignKey(Feed, related_name='fingerprints')
+    guid_key = models.CharField(max_length=40, db_index=True)
+    headline_key = models.CharField(max_length=40, db_index=True)
+    date_added = models.DateTimeField(auto_now_add=True)
+
+class ArticleTerm(models.Model):
+    """
+    One entry in the inverted index used to search articles: how much weight
+    a term carries in an article
+    """
+    term = models.CharField(max_length=50, db_index=True)
+    article = models.ForeignKey(Article, related_name='terms')
+    weight = models.PositiveIntegerField(default=1)
+
+class ArticleBand(models.Model):
+    """
+    One band of an article's fingerprint, i.e. '2:3f77' - recent articles
+    are looked up by band to find the near duplicates of a new article
+    """
+    key = models.CharField(max_length=8, db_index=True)
+    article = models.ForeignKey(Article, related_name='bands')
+    date_added = models.DateTimeField()
+
+# compiled whitelists are rebuilt whenever the models they come from change
+for model in (WhiteListFilter, FeedCategoryRelationship, CategoryRelationship):
+    signals.post_save.connect(clear_whitelists, sender=model)
+    signals.post_delete.connect(clear_whitelists, sender=model)
+
+# the cached category list is rebuilt whenever a category changes
+signals.post_save.connect(invalidate_category_list, sender=Category)
+signals.post_delete.connect(invalidate_category_list, sender=Category)
+
+# a renamed, moved or deleted category changes the urls of its subtree, so
+# every cached page goes
+signals.post_save.connect(invalidate_articles, sender=Category)
+signals.post_delete.connect(invalidate_articles, sender=Category)
@@ -0,0 +1,71 @@
+import datetime
+
+from django.db.models import Q
+
+CURSOR_FORMAT = '%Y%m%d%H%M%S'
+
+
+def encode_cursor(article):
+    """
+    Position of an article in the (publish, id) ordering, as a string that
+    can be put in a query string
+    """
+    return '%s%06d-%d' % (article.publish.strftime(CURSOR_FORMAT),
+                          article.publish.microsecond, article.pk)
+
+def decode_cursor(cursor):
+    """
+    Turn a cursor back into a (publish, id) 2-tuple, raising ValueError if it
+    is malformed
+    """
+    timestamp, pk = cursor.split('-')
+    if len(timestamp) != 20:
+        raise ValueError('Invalid cursor: %s' % cursor)
+    publish = datetime.datetime.strptime(timestamp[:14], CURSOR_FORMAT)
+    return publish.replace(microsecond=int(timestamp[14:])), int(pk)
+
+
+class CursorPaginator(object):
+    """
+    Keyset pagination over a queryset of articles, newest first.  Each page is
+    found with an indexed range query on (publish, id) relative to an article
+    on the neighbouring page, so deep pages cost no more than the first one
+    and no COUNT(*) is needed.
+    """
+    def __init__(self, queryset, per_page):
+        self.queryset = queryset
+        self.per_page = per_page
+    
+    def page(self, before=None, after=None):
+        """
+        Return the articles older than the ``before`` cursor, newer than the
+        ``after`` cursor, or the newest articles if neither is given, along
+        with whether there are older (next) and newer (previous) pages
+        """
+        if after:
+            publish, pk = decode_cursor(after)
+            qs = self.queryset.filter(Q(publish__gt=publish) |
+                                      Q(publish=publish, pk__gt=pk))
+            articles = list(qs.order_by('publish', 'id')[:self.per_page + 1])
+            has_previous = len(articles) > self.per_page
+            articles = articles[:self.per_page]
+            articles.reverse()
+            has_next = True
+        else:
+            qs = self.queryset
+            if before:
+                publish, pk = decode_cursor(before)
+                qs = qs.filter(Q(publish__lt=publish) |
+                               Q(publish=publish, pk__lt=pk))
+            articles = list(qs.order_by('-publish', '-id')[:self.per_page + 1])
+            has_next = len(articles) > self.per_page
+            articles = articles[:self.per_page]
+            has_previous = bool(before)
+        
+        return {
+            'object_list': articles,
+            'has_next': has_next and bool(articles),
+            'has_previous': has_previous and bool(articles),
+            'next_cursor': articles and encode_cursor(articles[-1]) or None,
+            'previous_cursor': articles and encode_cursor(articles[0]) or None,
+        }
@@ -0,0 +1,380 @@
+import csv
+from xml.etree import ElementTree
+
+from django.template.defaultfilters import slugify
+from django.utils.encoding import smart_str, smart_unicode
+
+from news.cache import invalidate_category_list
+from news.matching import clear_whitelists
+from news.models import Source, Feed, Category, CategoryRelationship, \
+    FeedCategoryRelationship, WhiteListFilter, LOOKUP_BATCH_SIZE
+from news.utils import chunked, insert_instances, insert_rows, m2m_pairs
+
+
+class ProvisioningError(Exception):
+    pass
+
+
+def normalize_path(url_path):
+    slugs = [slug for slug in smart_unicode(url_path).split('/') if slug]
+    if not slugs:
+        raise ProvisioningError('Empty category path')
+    return u'/'.join(slugs) + u'/'
+
+def parent_path(url_path):
+    return url_path[:url_path[:-1].rfind('/') + 1]
+
+def split_names(value):
+    return tuple([name.strip() for name in smart_unicode(value or '').split('|')
+                  if name.strip()])
+
+def parse_bool(value, default):
+    if value is None or value == '':
+        return default
+    return smart_unicode(value).lower() in ('1', 'true', 'yes', 'y')
+
+
+class Definitions(object):
+    """
+    Everything read from, or written to, an OPML or CSV file
+    """
+    def __init__(self):
+        self.sources = {}           # name -> (url, description)
+        self.whitelists = {}        # name -> keywords
+        self.categories = {}        # url_path -> name
+        self.feeds = {}             # url -> (name, source name, active, streaming)
+        self.feed_categories = {}   # (feed url, url_path) -> white-list names
+        self.includes = {}          # (url_path, included url_path) -> white-list names
+
+    def add_category(self, url_path, name=None):
+        """
+        Add a category along with any of its ancestors not added yet
+        """
+        url_path = normalize_path(url_path)
+        path = parent_path(url_path)
+        if path:
+            self.add_category(path)
+        if name or url_path not in self.categories:
+            self.categories[url_path] = smart_unicode(name or url_path[:-1].split('/')[-1])
+        return url_path
+
+    def add_feed(self, url, name, source, active=True, streaming=False):
+        url = smart_unicode(url)
+        self.feeds[url] = (smart_unicode(name), smart_unicode(source), active, streaming)
+        return url
+
+
+def read_opml(fh):
+    definitions = Definitions()
+    body = ElementTree.parse(fh).getroot().find('body')
+    if body is None:
+        raise ProvisioningError('No <body> in the OPML document')
+
+    def read_outlines(parent, url_path):
+        for outline in parent.findall('outline'):
+            kind = outline.get('type', '')
+            text = outline.get('text') or outline.get('title') or ''
+            if kind == 'whitelist':
+                definitions.whitelists[smart_unicode(text)] = smart_unicode(
+                    outline.get('keywords', ''))
+            elif kind == 'include':
+                if not url_path:
+                    raise ProvisioningError('Included category %s is not inside '
+                        'a category' % outline.get('category'))
+                included = definitions.add_category(outline.get('category', ''))
+                definitions.includes[(url_path, included)] = split_names(
+                    outline.get('whitelists'))
+            elif outline.get('xmlUrl'):
+                source = smart_unicode(outline.get('source') or text)
+                if source not in definitions.sources:
+                    definitions.sources[source] = (smart_unicode(
+                        outline.get('sourceUrl') or outline.get('htmlUrl') or ''), u'')
+                url = definitions.add_feed(outline.get('xmlUrl'), text, source,
+                    parse_bool(outline.get('active'), True),
+                    parse_bool(outline.get('streaming'), False))
+                if url_path:
+                    definitions.feed_categories[(url, url_path)] = split_names(
+                        outline.get('whitelists'))
+            else:
+                slug = outline.get('slug') or slugify(text)
+                read_outlines(outline, definitions.add_category(
+                    url_path + slug + '/', text))
+
+    read_outlines(body, u'')
+    return definitions
+
+def read_csv(fh):
+    definitions = Definitions()
+    for line, row in enumerate(csv.reader(fh)):
+        if not row or row[0].startswith('#'):
+            continue
+        kind = row[0].strip()
+        row = [smart_unicode(value.strip()) for value in row[1:]] + [u''] * 5
+        if kind == 'source':
+            definitions.sources[row[0]] = (row[1], row[2])
+        elif kind == 'whitelist':
+            definitions.whitelists[row[0]] = row[1]
+        elif kind == 'category':
+            definitions.add_category(row[0], row[1])
+        elif kind == 'feed':
+            definitions.add_feed(row[0], row[1], row[2],
+                parse_bool(row[3], True), parse_bool(row[4], False))
+        elif kind == 'feed_category':
+            definitions.feed_categories[(row[0], definitions.add_category(row[1]))] = \
+                split_names(row[2])
+        elif kind == 'include':
+            definitions.includes[(definitions.add_category(row[0]),
+                definitions.add_category(row[1]))] = split_names(row[2])
+        else:
+            raise ProvisioningError('Unknown row type %r on line %d' % (kind, line + 1))
+    return definitions
+
+def write_opml(definitions, fh):
+    root = ElementTree.Element('opml', version='1.0')
+    ElementTree.SubElement(ElementTree.SubElement(root, 'head'), 'title').text = 'News feeds'
+    body = ElementTree.SubElement(root, 'body')
+
+    for name, keywords in sorted(definitions.whitelists.items()):
+        ElementTree.SubElement(body, 'outline', type='whitelist', text=name,
+                               keywords=keywords)
+
+    # parents sort before their children
+    outlines = {u'': body}
+    for url_path in sorted(definitions.categories):
+        outlines[url_path] = ElementTree.SubElement(outlines[parent_path(url_path)],
+            'outline', text=definitions.categories[url_path],
+            slug=url_path[:-1].split('/')[-1])
+
+    def feed_outline(parent, url, whitelists=()):
+        name, source, active, streaming = definitions.feeds[url]
+        attrs = {'type': 'rss', 'text': name, 'xmlUrl': url, 'source': source,
+                 'sourceUrl': definitions.sources.get(source, (u'', u''))[0]}
+        if whitelists:
+            attrs['whitelists'] = u'|'.join(whitelists)
+        if not active:
+            attrs['active'] = 'false'
+        if streaming:
+            attrs['streaming'] = 'true'
+        ElementTree.SubElement(parent, 'outline', **attrs)
+
+    categorized = set()
+    for (url, url_path), whitelists in sorted(definitions.feed_categories.items()):
+        feed_outline(outlines[url_path], url, whitelists)
+        categorized.add(url)
+    for url in sorted(definitions.feeds):
+        if url not in categorized:
+            feed_outline(body, url)
+
+    for (url_path, included), whitelists in sorted(definitions.includes.items()):
+        attrs = {'type': 'include', 'category': included}
+        if whitelists:
+            attrs['whitelists'] = u'|'.join(whitelists)
+        ElementTree.SubElement(outlines[url_path], 'outline', **attrs)
+
+    fh.write('<?xml version="1.0" encoding="utf-8"?>\n')
+    ElementTree.ElementTree(root).write(fh, 'utf-8')
+
+def write_csv(definitions, fh):
+    writer = csv.writer(fh)
+    def write(*row):
+        writer.writerow([smart_str(value) for value in row])
+
+    for name, (url, description) in sorted(definitions.sources.items()):
+        write('source', name, url, description)
+    for name, keywords in sorted(definitions.whitelists.items()):
+        write('whitelist', name, keywords)
+    for url_path, name in sorted(definitions.categories.items()):
+        write('category', url_path, name)
+    for url, (name, source, active, streaming) in sorted(definitions.feeds.items()):
+        write('feed', url, name, source, active and 'true' or 'false',
+              streaming and 'true' or 'false')
+    for (url, url_path), whitelists in sorted(definitions.feed_categories.items()):
+        write('feed_category', url, url_path, u'|'.join(whitelists))
+    for (url_path, included), whitelists in sorted(definitions.includes.items()):
+        write('include', url_path, included, u'|'.join(whitelists))
+
+
+def lookup(model, field, values):
+    """
+    Map values of a field to the pks of the rows that have them
+    """
+    pks = {}
+    for chunk in chunked(set(values), LOOKUP_BATCH_SIZE):
+        for value, pk in model.objects.filter(**{'%s__in' % field: chunk}
+            ).values_list(field, 'id'):
+            pks.setdefault(value, pk)
+    return pks
+
+def create_missing(model, field, instances):
+    """
+    Insert the instances, given as a dictionary keyed on the value of
+    ``field``, that are not in the database yet.  Returns a dictionary of
+    every value to its pk, and the number of rows inserted.
+    """
+    pks = lookup(model, field, instances.keys())
+    missing = [instances[value] for value in sorted(instances) if value not in pks]
+    insert_instances(model, missing)
+    pks.update(lookup(model, field, [getattr(obj, field) for obj in missing]))
+    return pks, len(missing)
+
+def load(definitions):
+    """
+    Create whatever is described by the definitions and is not in the
+    database yet - rows that already exist are left as they are.  Rows are
+    inserted in bulk, without calling save(), so this should be run in a
+    single transaction.  Returns the number of rows created of each kind.
+    """
+    created = {}
+
+    whitelist_names = set(definitions.whitelists)
+    for names in definitions.feed_categories.values() + definitions.includes.values():
+        whitelist_names.update(names)
+    whitelist_ids, created['whitelists'] = create_missing(WhiteListFilter, 'name',
+        dict([(name, WhiteListFilter(name=name, keywords=keywords)) for
+              name, keywords in definitions.whitelists.items()]))
+    whitelist_ids.update(lookup(WhiteListFilter, 'name',
+        whitelist_names.difference(whitelist_ids)))
+    unknown = whitelist_names.difference(whitelist_ids)
+    if unknown:
+        raise ProvisioningError('Unknown white-lists: %s' % ', '.join(sorted(unknown)))
+
+    source_ids, created['sources'] = create_missing(Source, 'name',
+        dict([(name, Source(name=name, url=url, description=description)) for
+              name, (url, description) in definitions.sources.items()]))
+    source_names = set([source for _, source, _, _ in definitions.feeds.values()])
+    source_ids.update(lookup(Source, 'name', source_names.difference(source_ids)))
+    unknown = source_names.difference(source_ids)
+    if unknown:
+        raise ProvisioningError('Unknown sources: %s' % ', '.join(sorted(unknown)))
+
+    # categories are inserted a level at a time, so that every category's
+    # parent is in the database before it, with the url_path and level that
+    # Category.save() would have worked out
+    category_ids = lookup(Category, 'url_path', definitions.categories.keys())
+    new_categories = {}
+    for url_path in definitions.categories:
+        if url_path not in category_ids:
+            new_categories.setdefault(url_path.count('/') - 1, []).append(url_path)
+
+    slugs = {}
+    for url_paths in new_categories.values():
+        for url_path in url_paths:
+            slug = url_path[:-1].split('/')[-1]
+            if slug in slugs:
+                raise ProvisioningError('Categories %s and %s share the slug %s' % (
+                    slugs[slug], url_path, slug))
+            slugs[slug] = url_path
+    taken = lookup(Category, 'slug', slugs.keys())
+    if taken:
+        raise ProvisioningError('Slugs already used by other categories: %s' %
+                                ', '.join(sorted(taken)))
+
+    created['categories'] = 0
+    for level in sorted(new_categories):
+        url_paths = sorted(new_categories[level])
+        insert_instances(Category, [Category(
+            name=definitions.categories[url_path],
+            slug=url_path[:-1].split('/')[-1],
+            parent_id=category_ids.get(parent_path(url_path)),
+            url_path=url_path,
+            level=level) for url_path in url_paths])
+        category_ids.update(lookup(Category, 'url_path', url_paths))
+        created['categories'] += len(url_paths)
+
+    feed_ids, created['feeds'] = create_missing(Feed, 'url',
+        dict([(url, Feed(url=url, name=name, source_id=source_ids[source],
+                         active=active, streaming=streaming)) for
+              url, (name, source, active, streaming) in definitions.feeds.items()]))
+    feed_urls = set([url for url, _ in definitions.feed_categories])
+    feed_ids.update(lookup(Feed, 'url', feed_urls.difference(feed_ids)))
+    unknown = feed_urls.difference(feed_ids)
+    if unknown:
+        raise ProvisioningError('Unknown feeds: %s' % ', '.join(sorted(unknown)))
+
+    created['feed_categories'] = create_relationships(FeedCategoryRelationship,
+        'feed', 'category', dict([((feed_ids[url], category_ids[url_path]),
+            [whitelist_ids[name] for name in whitelists]) for
+            (url, url_path), whitelists in definitions.feed_categories.items()]))
+    created['includes'] = create_relationships(CategoryRelationship,
+        'category', 'included_category', dict([((category_ids[url_path],
+            category_ids[included]), [whitelist_ids[name] for name in whitelists])
+            for (url_path, included), whitelists in definitions.includes.items()]))
+
+    # nothing was saved, so no signals were sent
+    clear_whitelists()
+    invalidate_category_list()
+    return created
+
+def create_relationships(model, from_field, to_field, relationships):
+    """
+    Insert the relationships, given as a dictionary of (from pk, to pk) ->
+    white-list pks, that do not exist yet along with their white-lists
+    """
+    from_column = model._meta.get_field(from_field).column
+    to_column = model._meta.get_field(to_field).column
+
+    def existing():
+        pks = {}
+        from_ids = set([from_id for from_id, _ in relationships])
+        for chunk in chunked(from_ids, LOOKUP_BATCH_SIZE):
+            for from_id, to_id, pk in model.objects.filter(**{'%s__in' % from_field:
+                chunk}).values_list(from_field, to_field, 'id'):
+                pks[(from_id, to_id)] = pk
+        return pks
+
+    pks = existing()
+    missing = [pair for pair in sorted(relationships) if pair not in pks]
+    if not missing:
+        return 0
+    insert_rows(model._meta.db_table, [from_column, to_column], missing)
+
+    pks = existing()
+    field = model._meta.get_field('white_list')
+    insert_rows(field.m2m_db_table(),
+        [field.m2m_column_name(), field.m2m_reverse_name()],
+        [(pks[pair], whitelist_id) for pair in missing for
+         whitelist_id in set(relationships[pair])])
+    return len(missing)
+
+def dump():
+    """
+    Definitions of everything in the database, read with a query per table
+    """
+    definitions = Definitions()
+
+    sources = {}
+    for pk, name, url, description in Source.objects.values_list('id', 'name',
+        'url', 'description'):
+        sources[pk] = name
+        definitions.sources[name] = (url, description)
+
+    whitelists = {}
+    for pk, name, keywords in WhiteListFilter.objects.values_list('id', 'name',
+        'keywords'):
+        whitelists[pk] = name
+        definitions.whitelists[name] = keywords
+
+    categories = {}
+    for pk, url_path, name in Category.objects.values_list('id', 'url_path', 'name'):
+        categories[pk] = url_path
+        definitions.categories[url_path] = name
+
+    feeds = {}
+    for pk, url, name, source_id, active, streaming in Feed.objects.values_list(
+        'id', 'url', 'name', 'source', 'active', 'streaming'):
+        feeds[pk] = url
+        definitions.add_feed(url, name, sources[source_id], active, streaming)
+
+    for model, from_field, to_field, targets, relationships in (
+        (FeedCategoryRelationship, 'feed', 'category', feeds,
+         definitions.feed_categories),
+        (CategoryRelationship, 'category', 'included_category', categories,
+         definitions.includes)):
+        names = {}
+        for pk, whitelist_id in m2m_pairs(model, 'white_list'):
+            names.setdefault(pk, []).append(whitelists[whitelist_id])
+        for pk, from_id, to_id in model.objects.values_list('id', from_field, to_field):
+            relationships[(targets[from_id], categories[to_id])] = tuple(
+                sorted(names.get(pk, [])))
+
+    return definitions
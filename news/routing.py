@@ -0,0 +1,57 @@
+class CategoryGraph(object):
+    """
+    In-memory graph of CategoryRelationships, mapping each category to the
+    categories that include it.  Used to find every category an article ends
+    up in without going back to the database, following includes
+    transitively and stopping at cycles.
+    """
+    def __init__(self, category_rules):
+        # category id -> list of (including category id, matcher or None)
+        self.rules = category_rules
+        
+        # category id -> frozenset of every category it reaches, for the
+        # categories whose includes carry no whitelists at all and can
+        # therefore be resolved ahead of time
+        self.closures = {}
+        for category_id in self.rules:
+            reachable = self.reachable(category_id)
+            if reachable is not None:
+                self.closures[category_id] = reachable
+    
+    def reachable(self, category_id):
+        """
+        Walk the includes starting at a category, returning the set of
+        categories visited or None if any of them are whitelisted
+        """
+        seen = set([category_id])
+        stack = [category_id]
+        while stack:
+            for including_id, matcher in self.rules.get(stack.pop(), ()):
+                if matcher is not None:
+                    return None
+                if including_id not in seen:
+                    seen.add(including_id)
+                    stack.append(including_id)
+        return frozenset(seen)
+    
+    def resolve(self, category_ids, headline):
+        """
+        Return the ids of the given categories plus every category that
+        includes them, directly or indirectly, whose whitelists the headline
+        passes
+        """
+        resolved = set()
+        stack = list(category_ids)
+        while stack:
+            category_id = stack.pop()
+            if category_id in resolved:
+                continue
+            if category_id in self.closures:
+                resolved.update(self.closures[category_id])
+                continue
+            resolved.add(category_id)
+            for including_id, matcher in self.rules.get(category_id, ()):
+                if including_id not in resolved and \
+                   (matcher is None or matcher.matches(headline)):
+                    stack.append(including_id)
+        return resolved
@@ -0,0 +1,123 @@
+import re
+from HTMLParser import HTMLParser, HTMLParseError
+
+from django.conf import settings
+
+# blocked html takes a list of tag names, i.e. ['script', 'img', 'embed']
+BLOCKED_HTML = frozenset([tag.lower() for tag in 
+                          getattr(settings, 'NEWS_BLOCKED_HTML', [])])
+
+# elements that never have content or a closing tag
+VOID_ELEMENTS = frozenset(['area', 'base', 'br', 'col', 'embed', 'hr', 'img',
+                           'input', 'link', 'meta', 'param', 'source', 'wbr'])
+
+# elements whose end tag may be left out, and the start tags that end them
+IMPLIED_END = {
+    'p': frozenset(['address', 'article', 'aside', 'blockquote', 'div', 'dl',
+                    'fieldset', 'footer', 'form', 'h1', 'h2', 'h3', 'h4', 'h5',
+                    'h6', 'header', 'hr', 'menu', 'nav', 'ol', 'p', 'pre',
+                    'section', 'table', 'ul']),
+    'li': frozenset(['li']),
+    'dt': frozenset(['dt', 'dd']),
+    'dd': frozenset(['dt', 'dd']),
+    'option': frozenset(['option', 'optgroup']),
+    'tr': frozenset(['tr']),
+    'td': frozenset(['td', 'th', 'tr']),
+    'th': frozenset(['td', 'th', 'tr']),
+}
+
+TAG_RE = re.compile(r'<[^>]*>')
+
+
+class BlockedTagFilter(HTMLParser):
+    """
+    Copies HTML through in a single pass, dropping the blocked elements along
+    with everything inside them.  Markup that is let through is reproduced as
+    it appeared in the source.  A blocked element that is never closed ends
+    where its end tag could be left out, or with its parent (or the document).
+    """
+    def __init__(self, blocked):
+        HTMLParser.__init__(self)
+        self.blocked = blocked
+        self.output = []
+        # every element that is currently open, innermost last, and how many
+        # of them are blocked
+        self.open_elements = []
+        self.open_blocked = 0
+    
+    def close_to(self, index):
+        # close the open elements from index onwards
+        for tag in self.open_elements[index:]:
+            if tag in self.blocked:
+                self.open_blocked -= 1
+        del self.open_elements[index:]
+    
+    def handle_starttag(self, tag, attrs):
+        while self.open_elements and \
+              tag in IMPLIED_END.get(self.open_elements[-1], ()):
+            self.close_to(len(self.open_elements) - 1)
+        if tag not in self.blocked and not self.open_blocked:
+            self.output.append(self.get_starttag_text())
+        if tag not in VOID_ELEMENTS:
+            self.open_elements.append(tag)
+            if tag in self.blocked:
+                self.open_blocked += 1
+    
+    def close(self):
+        HTMLParser.close(self)
+        # anything still open ends with the document
+        self.close_to(0)
+    
+    def handle_startendtag(self, tag, attrs):
+        if tag not in self.blocked and not self.open_blocked:
+            self.output.append(self.get_starttag_text())
+    
+    def handle_endtag(self, tag):
+        if tag in self.open_elements:
+            # close the most recently opened element of this kind, and
+            # anything left open inside it
+            index = len(self.open_elements) - 1
+            while self.open_elements[index] != tag:
+                index -= 1
+            self.close_to(index)
+        if tag not in self.blocked and not self.open_blocked:
+            self.output.append('</%s>' % tag)
+    
+    def emit(self, text):
+        if not self.open_blocked:
+            self.output.append(text)
+    
+    def handle_data(self, data):
+        self.emit(data)
+    
+    def handle_entityref(self, name):
+        self.emit('&%s;' % name)
+    
+    def handle_charref(self, name):
+        self.emit('&#%s;' % name)
+    
+    def handle_comment(self, data):
+        self.emit('<!--%s-->' % data)
+    
+    def handle_decl(self, decl):
+        self.emit('<!%s>' % decl)
+    
+    def handle_pi(self, data):
+        self.emit('<?%s>' % data)
+
+
+def sanitize(html, blocked=BLOCKED_HTML):
+    """
+    Remove the blocked elements, and their contents, from a piece of HTML.
+    Runs in time linear in the length of the HTML.
+    """
+    if not blocked or '<' not in html:
+        return html
+    parser = BlockedTagFilter(blocked)
+    try:
+        parser.feed(html)
+        parser.close()
+    except HTMLParseError:
+        # too broken to tell what is inside what - keep the text only
+        return TAG_RE.sub('', html)
+    return ''.join(parser.output)
@@ -0,0 +1,65 @@
+import datetime
+import random
+import time
+
+from django.conf import settings
+
+# bounds, in seconds, on how often a feed is downloaded
+MIN_DOWNLOAD_INTERVAL = getattr(settings, 'NEWS_MIN_DOWNLOAD_INTERVAL', 15 * 60)
+MAX_DOWNLOAD_INTERVAL = getattr(settings, 'NEWS_MAX_DOWNLOAD_INTERVAL', 24 * 60 * 60)
+
+# how far either side of the computed time a download is scheduled, as a
+# fraction of the interval, so feeds added together drift apart
+DOWNLOAD_JITTER = getattr(settings, 'NEWS_DOWNLOAD_JITTER', 0.1)
+
+# how much faster or slower the interval moves when a download does or does
+# not turn up anything new
+BACKOFF_FACTOR = 1.5
+
+
+def clamp(interval):
+    return int(min(max(interval, MIN_DOWNLOAD_INTERVAL), MAX_DOWNLOAD_INTERVAL))
+
+def publish_interval(publish_dates):
+    """
+    Average number of seconds between the entries of a feed, given their
+    parsed publish dates as time tuples, or None if it cannot be told
+    """
+    timestamps = []
+    for publish_date in publish_dates:
+        try:
+            timestamps.append(time.mktime(publish_date))
+        except (TypeError, ValueError, OverflowError):
+            pass
+    if len(timestamps) < 2:
+        return None
+    spread = max(timestamps) - min(timestamps)
+    if spread <= 0:
+        return None
+    return spread / (len(timestamps) - 1)
+
+def schedule_download(feed, new_articles=0, publish_dates=(), error=False):
+    """
+    Work out when a feed should next be downloaded.  Feeds that turn up new
+    articles are polled more often, tending towards the rate their entries
+    are published at, feeds that don't are polled less often, and failing
+    feeds back off exponentially.  Sets the scheduling fields on the feed but
+    does not save it.
+    """
+    if error:
+        feed.download_errors += 1
+        interval = max(feed.download_interval,
+                       MIN_DOWNLOAD_INTERVAL * 2 ** min(feed.download_errors, 16))
+    else:
+        feed.download_errors = 0
+        if new_articles:
+            target = publish_interval(publish_dates) or \
+                     feed.download_interval / BACKOFF_FACTOR
+            feed.download_interval = clamp((feed.download_interval + target) / 2)
+        else:
+            feed.download_interval = clamp(feed.download_interval * BACKOFF_FACTOR)
+        interval = feed.download_interval
+    
+    interval = clamp(interval) * random.uniform(1 - DOWNLOAD_JITTER, 1 + DOWNLOAD_JITTER)
+    feed.next_download = datetime.datetime.now() + \
+                         datetime.timedelta(seconds=int(interval))
@@ -0,0 +1,111 @@
+import re
+
+from django.conf import settings
+from django.db import connection
+from django.utils.encoding import smart_unicode
+from django.utils.importlib import import_module
+
+from news.utils import insert_rows
+
+# dotted path to the class used to index and search articles
+SEARCH_BACKEND = getattr(settings, 'NEWS_SEARCH_BACKEND',
+                         'news.search.InvertedIndexBackend')
+
+# how much more a term counts for when it appears in the headline
+HEADLINE_WEIGHT = getattr(settings, 'NEWS_SEARCH_HEADLINE_WEIGHT', 5)
+
+TAG_RE = re.compile(r'<[^>]*>')
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+STOP_WORDS = frozenset([
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'but', 'by', 'for', 'from',
+    'has', 'have', 'he', 'in', 'is', 'it', 'its', 'of', 'on', 'or', 'that',
+    'the', 'this', 'to', 'was', 'were', 'will', 'with'])
+
+MAX_TERM_LENGTH = 50
+
+
+def tokenize(text):
+    """
+    Split a piece of text, which may contain HTML, into lowercased search
+    terms
+    """
+    text = TAG_RE.sub(' ', smart_unicode(text)).lower()
+    return [word for word in WORD_RE.findall(text)
+            if len(word) > 1 and word not in STOP_WORDS and
+            len(word) <= MAX_TERM_LENGTH]
+
+
+class BaseSearchBackend(object):
+    def index(self, articles):
+        """
+        Add newly created articles to the index
+        """
+        pass
+    
+    def search(self, queryset, query):
+        """
+        Restrict a queryset of articles to those matching the query, ordered
+        by relevance
+        """
+        raise NotImplementedError
+
+
+class SimpleSearchBackend(BaseSearchBackend):
+    """
+    Searches headlines with a LIKE query - needs no index, but scans the whole
+    article table
+    """
+    def search(self, queryset, query):
+        return queryset.filter(headline__icontains=query)
+
+
+class InvertedIndexBackend(BaseSearchBackend):
+    """
+    Searches an inverted index of the terms in each article's headline and
+    content, stored in the ArticleTerm table.  Articles must contain every
+    term in the query, and are ranked by the summed weight of those terms.
+    """
+    def index(self, articles):
+        from news.models import ArticleTerm
+        rows = []
+        for article in articles:
+            weights = {}
+            for term in tokenize(article.headline):
+                weights[term] = weights.get(term, 0) + HEADLINE_WEIGHT
+            for term in tokenize(article.content):
+                weights[term] = weights.get(term, 0) + 1
+            rows.extend([(term, article.pk, weight) for term, weight in weights.items()])
+        insert_rows(ArticleTerm._meta.db_table, ['term', 'article_id', 'weight'], rows)
+    
+    def search(self, queryset, query):
+        from news.models import Article, ArticleTerm
+        terms = list(set(tokenize(query)))
+        if not terms:
+            return queryset.none()
+        
+        qn = connection.ops.quote_name
+        term_table = qn(ArticleTerm._meta.db_table)
+        article_pk = '%s.%s' % (qn(Article._meta.db_table), qn(Article._meta.pk.column))
+        term_list = ', '.join(['%s'] * len(terms))
+        
+        rank = 'SELECT SUM(weight) FROM %s WHERE article_id = %s AND term IN (%s)' % (
+            term_table, article_pk, term_list)
+        matches = '%s IN (SELECT article_id FROM %s WHERE term IN (%s) ' \
+                  'GROUP BY article_id HAVING COUNT(*) = %d)' % (
+            article_pk, term_table, term_list, len(terms))
+        
+        return queryset.extra(
+            select={'search_rank': rank}, select_params=terms,
+            where=[matches], params=terms,
+            order_by=['-search_rank', '-publish'])
+
+
+_backend = None
+
+def get_search_backend():
+    global _backend
+    if _backend is None:
+        module, attr = SEARCH_BACKEND.rsplit('.', 1)
+        _backend = getattr(import_module(module), attr)()
+    return _backend
@@ -0,0 +1,11 @@
+-- Executed by syncdb after the news tables are created.  Existing installs can
+-- run these statements by hand.
+
+-- category listings, including subcategory listings that join on url_path,
+-- go from category to article through the join table
+CREATE INDEX news_article_categories_category_article
+    ON news_article_categories (category_id, article_id);
+
+-- every listing filters out expired articles and orders by publish date
+CREATE INDEX news_article_expired_publish
+    ON news_article (expired, publish);
@@ -0,0 +1,173 @@
+import logging
+import os
+import tempfile
+from xml.etree import cElementTree as ElementTree
+
+import feedparser
+
+from news.fetcher import open_feed, read_body
+
+RSS_NAMESPACES = ('', 'http://purl.org/rss/1.0/',
+                  'http://my.netscape.com/rdf/simple/0.9/')
+ATOM_NAMESPACES = ('http://www.w3.org/2005/Atom', 'http://purl.org/atom/ns#')
+CONTENT_NAMESPACE = 'http://purl.org/rss/1.0/modules/content/'
+DC_NAMESPACE = 'http://purl.org/dc/elements/1.1/'
+
+def qualified_names(namespaces, names):
+    return frozenset(['%s%s' % (ns and '{%s}' % ns, name)
+                      for ns in namespaces for name in names])
+
+# the elements each field of an entry is read from - extensions like Media
+# RSS and iTunes use the same local names, so names must match with their
+# namespace
+TITLE_TAGS = qualified_names(RSS_NAMESPACES + ATOM_NAMESPACES, ['title'])
+LINK_TAGS = qualified_names(RSS_NAMESPACES + ATOM_NAMESPACES, ['link'])
+ID_TAGS = qualified_names(RSS_NAMESPACES, ['guid']) | \
+    qualified_names(ATOM_NAMESPACES, ['id'])
+SUMMARY_TAGS = qualified_names(RSS_NAMESPACES, ['description']) | \
+    qualified_names(ATOM_NAMESPACES, ['summary'])
+CONTENT_TAGS = qualified_names([CONTENT_NAMESPACE], ['encoded']) | \
+    qualified_names(ATOM_NAMESPACES, ['content'])
+PUBLISHED_TAGS = qualified_names(RSS_NAMESPACES, ['pubDate']) | \
+    qualified_names(ATOM_NAMESPACES, ['published', 'issued'])
+UPDATED_TAGS = qualified_names(ATOM_NAMESPACES, ['updated', 'modified']) | \
+    qualified_names([DC_NAMESPACE], ['date'])
+
+
+class StreamEntry(dict):
+    """
+    A single entry read from a streamed feed, supporting the attribute access
+    of feedparser's entries
+    """
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+    
+    def __setattr__(self, name, value):
+        self[name] = value
+
+
+class StreamContent(object):
+    def __init__(self, value):
+        self.value = value
+
+
+def local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+def inner_text(element):
+    """
+    Text of an element, including the markup of any child elements (inline
+    XHTML content)
+    """
+    parts = [element.text or '']
+    for child in element:
+        parts.append(ElementTree.tostring(child))
+    return u''.join([part.decode('utf-8') if isinstance(part, str) else part
+                     for part in parts]).strip()
+
+def parse_entry(element):
+    """
+    Turn an RSS <item> or Atom <entry> element into a StreamEntry
+    """
+    entry = StreamEntry(title=u'', link=u'')
+    for child in element:
+        tag = child.tag
+        text = (child.text or u'').strip()
+        if tag in TITLE_TAGS:
+            entry['title'] = inner_text(child)
+        elif tag in LINK_TAGS:
+            if child.get('href') is None:
+                entry['link'] = text
+            elif child.get('rel', 'alternate') == 'alternate' and not entry['link']:
+                entry['link'] = child.get('href')
+        elif tag in ID_TAGS:
+            entry['id'] = text
+        elif tag in SUMMARY_TAGS:
+            entry['summary'] = inner_text(child)
+        elif tag in CONTENT_TAGS:
+            entry['content'] = [StreamContent(inner_text(child))]
+        elif tag in PUBLISHED_TAGS:
+            entry['published_parsed'] = feedparser._parse_date(text)
+        elif tag in UPDATED_TAGS:
+            entry['updated_parsed'] = feedparser._parse_date(text)
+    return entry
+
+def iter_entries(fh):
+    """
+    Yield the entries of an RSS or Atom document one at a time as it is
+    parsed.  Each entry's element is thrown away once it has been read, so
+    memory use does not grow with the size of the document.
+    """
+    stack = []
+    try:
+        for event, element in ElementTree.iterparse(fh, events=('start', 'end')):
+            if event == 'start':
+                stack.append(element)
+                continue
+            stack.pop()
+            if local_name(element.tag) in ('item', 'entry'):
+                yield parse_entry(element)
+                if stack:
+                    stack[-1].remove(element)
+    except SyntaxError as e:
+        # keep the entries read before the document went bad
+        logging.warn("Error parsing feed: %s" % e)
+
+
+class StreamedFeed(object):
+    """
+    A downloaded feed whose entries are parsed lazily, standing in for the
+    result of feedparser.parse()
+    """
+    streaming = True
+    encoding = 'utf-8'
+    
+    def __init__(self, fh=None, status=200, headers=None, bytes=0):
+        self.fh = fh
+        self.status = status
+        self.headers = headers or {}
+        self.etag = self.headers.get('etag', '')
+        self.modified = self.headers.get('last-modified', '')
+        self.bytes = bytes
+        self.feed = {}
+        if fh is None:
+            self.entries = iter([])
+        else:
+            self.entries = iter_entries(fh)
+    
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+    
+    def close(self):
+        if self.fh is not None:
+            self.fh.close()
+
+
+def fetch_stream(url, etag=None, modified=None, deadline=None):
+    """
+    Download a feed to a temporary file, without parsing it, and return a
+    StreamedFeed that parses it on demand.  Sends the ETag and Last-Modified
+    validators, if given, so an unchanged feed comes back as a 304.  Gives up
+    once time.time() passes ``deadline``.
+    """
+    if '://' not in url:
+        return StreamedFeed(open(url, 'rb'), bytes=os.path.getsize(url))
+    
+    response = open_feed(url, etag, modified)
+    if response.code >= 300:
+        response.close()
+        return StreamedFeed(status=response.code,
+                            headers=dict(response.info().items()))
+    
+    spool = tempfile.TemporaryFile()
+    try:
+        bytes = read_body(response, spool, deadline)
+    finally:
+        response.close()
+    spool.seek(0)
+    
+    return StreamedFeed(spool, status=response.code,
+                        headers=dict(response.info().items()), bytes=bytes)
@@ -0,0 +1,117 @@
+import time
+
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+from django.utils import feedgenerator
+from django.utils.encoding import smart_str, smart_unicode
+from django.utils.hashcompat import md5_constructor
+from django.utils.http import http_date
+
+from news.cache import CACHE_TIMEOUT, get_version, make_key
+
+# number of articles in each category's feed
+FEED_ITEMS = getattr(settings, 'NEWS_FEED_ITEMS', 20)
+
+# whether a category's feed also carries the articles in its subcategories,
+# following the article listings by default
+FEED_INCLUDE_SUBCATEGORIES = getattr(settings, 'NEWS_FEED_INCLUDE_SUBCATEGORIES',
+    getattr(settings, 'NEWS_INCLUDE_SUBCATEGORIES', False))
+
+FEED_FORMATS = {
+    'rss': feedgenerator.Rss201rev2Feed,
+    'atom': feedgenerator.Atom1Feed,
+}
+
+
+def add_domain(path):
+    return 'http://%s%s' % (Site.objects.get_current().domain, path)
+
+def render_feed(url_path, format):
+    """
+    Serialize the latest articles of a category, or of every category if
+    url_path is empty.  Returns a dictionary with the document and the
+    validators to send with it, or None if the category does not exist.
+    """
+    from news.models import Article, Category
+    category = None
+    if url_path:
+        try:
+            category = Category.objects.get(url_path=url_path)
+        except Category.DoesNotExist:
+            return None
+    
+    articles = list(Article.objects.listed(category, FEED_INCLUDE_SUBCATEGORIES
+        ).defer('content').order_by('-publish', '-pk')[:FEED_ITEMS])
+    
+    feed_class = FEED_FORMATS[format]
+    feed = feed_class(
+        title=category and category.name or 'Latest news',
+        link=add_domain(reverse('news_article_index', 
+                                kwargs={'url_path': url_path})),
+        description=u'',
+        feed_url=add_domain(reverse('news_category_feed',
+            kwargs={'format': format, 'url_path': url_path})),
+    )
+    for article in articles:
+        feed.add_item(
+            title=smart_unicode(article.headline),
+            link=smart_unicode(article.url),
+            description=smart_unicode(article.teaser),
+            unique_id=smart_unicode(article.guid or article.url),
+            pubdate=article.publish,
+        )
+    content = feed.writeString('utf-8')
+    
+    # the feed changes whenever an article is added to it
+    if articles:
+        modified = max([article.date_added for article in articles])
+        last_modified = http_date(time.mktime(modified.timetuple()))
+    else:
+        last_modified = None
+    
+    return {
+        'content': content,
+        'mime_type': feed.mime_type,
+        'etag': '"%s"' % md5_constructor(smart_str(content)).hexdigest(),
+        'last_modified': last_modified,
+    }
+
+def feed_key(url_path, format):
+    """
+    Cache key for a category's feed, which changes along with the key of the
+    category's article listing
+    """
+    return make_key('feed', get_version('articles'),
+                    get_version('articles:%s' % url_path), url_path, format)
+
+def get_feed(url_path, format):
+    """
+    A category's serialized feed, rendered at most once for each version of
+    the category when caching is enabled
+    """
+    if not CACHE_TIMEOUT:
+        return render_feed(url_path, format)
+    key = feed_key(url_path, format)
+    feed = cache.get(key)
+    if feed is None:
+        feed = render_feed(url_path, format)
+        if feed is not None:
+            cache.set(key, feed, CACHE_TIMEOUT)
+    return feed
+
+def prerender_feeds():
+    """
+    Render the feeds of every category that has changed since they were last
+    cached, so that polling clients are served from the cache.  Called at the
+    end of process_news_feeds.  Returns the number of feeds checked.
+    """
+    from news.models import Category
+    if not CACHE_TIMEOUT:
+        return 0
+    url_paths = [''] + list(Category.objects.values_list('url_path', flat=True))
+    for url_path in url_paths:
+        for format in FEED_FORMATS:
+            get_feed(url_path, format)
+    return len(url_paths) * len(FEED_FORMATS)
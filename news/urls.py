@@ -1,6 +1,10 @@
 from django.conf.urls.defaults import *
 
 urlpatterns = patterns('news.views',
+    url(r'^feeds/(?P<format>rss|atom)/(?P<url_path>[/\w-]*)$',
+        view='category_feed',
+        name='news_category_feed'
+    ),
     url(r'^(?P<url_path>[/\w-]*)',
         view='article_list',
         name='news_article_index'
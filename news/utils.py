@@ -0,0 +1,125 @@
+from django.utils.encoding import smart_str, smart_unicode
+from django.utils.hashcompat import sha_constructor
+
+
+def chunked(iterable, size):
+    """
+    Split an iterable into lists of at most ``size`` items, keeping IN
+    clauses under the limits imposed by some databases
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def normalize_headline(headline):
+    """
+    Lowercase a headline and collapse its whitespace, so that headlines
+    differing only in case or spacing compare equal
+    """
+    return u' '.join(smart_unicode(headline).lower().split())
+
+def fingerprint(value):
+    """
+    A fixed-length, indexable digest of a string
+    """
+    return sha_constructor(smart_str(value)).hexdigest()
+
+def headline_key(headline):
+    """
+    A fixed-length, indexable digest of the normalized headline
+    """
+    return fingerprint(normalize_headline(headline))
+
+def make_teaser(html, words, max_length):
+    """
+    The opening ``words`` words of a piece of HTML, with any tags left open
+    by the cut closed again.  If that is still longer than ``max_length``
+    characters the markup is dropped and the text cut to fit.
+    """
+    from django.utils.html import strip_tags
+    from django.utils.text import truncate_html_words
+    teaser = truncate_html_words(html, words)
+    if len(teaser) > max_length:
+        teaser = u' '.join(strip_tags(teaser).split())
+        if len(teaser) > max_length:
+            teaser = teaser[:max_length].rsplit(u' ', 1)[0] + u' ...'
+    return teaser
+
+def m2m_pairs(model, field_name):
+    """
+    Read every row of a many-to-many join table in a single query, returning
+    a list of (model pk, related pk) 2-tuples
+    """
+    from django.db import connection
+    qn = connection.ops.quote_name
+    field = model._meta.get_field(field_name)
+    cursor = connection.cursor()
+    cursor.execute('SELECT %s, %s FROM %s' % (
+        qn(field.m2m_column_name()),
+        qn(field.m2m_reverse_name()),
+        qn(field.m2m_db_table())))
+    return cursor.fetchall()
+
+def insert_rows(table, columns, rows):
+    """
+    Insert rows into a table with multi-row INSERT statements, keeping each
+    statement under the bound parameter limits of SQLite
+    """
+    from django.db import connection, transaction
+    if not rows:
+        return
+    qn = connection.ops.quote_name
+    placeholders = '(%s)' % ', '.join(['%s'] * len(columns))
+    cursor = connection.cursor()
+    for chunk in chunked(rows, max(1, 999 // len(columns))):
+        sql = 'INSERT INTO %s (%s) VALUES %s' % (
+            qn(table),
+            ', '.join([qn(column) for column in columns]),
+            ', '.join([placeholders] * len(chunk)))
+        params = []
+        for row in chunk:
+            params.extend(row)
+        cursor.execute(sql, params)
+    transaction.commit_unless_managed()
+
+def insert_instances(model, instances):
+    """
+    Insert unsaved model instances in bulk.  Field defaults and auto_now_add
+    values are applied, but primary keys are not set on the instances.
+    """
+    from django.db.models import AutoField
+    fields = [f for f in model._meta.local_fields if not isinstance(f, AutoField)]
+    rows = []
+    for instance in instances:
+        rows.append([f.get_db_prep_save(f.pre_save(instance, True)) for f in fields])
+    insert_rows(model._meta.db_table, [f.column for f in fields], rows)
+
+def delete_related_rows(model, pks):
+    """
+    Remove the rows that point at the given instances of a model with a
+    single statement per table - many-to-many rows and rows with a non-null
+    foreign key are deleted, nullable foreign keys are cleared
+    """
+    from django.db import connection
+    qn = connection.ops.quote_name
+    placeholders = ', '.join(['%s'] * len(pks))
+    cursor = connection.cursor()
+    for field in model._meta.many_to_many:
+        cursor.execute('DELETE FROM %s WHERE %s IN (%s)' % (
+            qn(field.m2m_db_table()), qn(field.m2m_column_name()),
+            placeholders), pks)
+    for related in model._meta.get_all_related_objects():
+        table = qn(related.model._meta.db_table)
+        column = qn(related.field.column)
+        if related.field.null:
+            sql = 'UPDATE %s SET %s = NULL WHERE %s IN (%s)' % (
+                table, column, column, placeholders)
+        else:
+            sql = 'DELETE FROM %s WHERE %s IN (%s)' % (
+                table, column, placeholders)
+        cursor.execute(sql, pks)
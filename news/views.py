@@ -1,29 +1,138 @@
 from django.conf import settings
+from django.core.cache import cache
+from django.http import Http404, HttpResponse, HttpResponseNotModified
 from django.views.generic.list_detail import object_list
-from django.shortcuts import get_object_or_404
+from django.shortcuts import get_object_or_404, render_to_response
+from django.template import RequestContext
+from django.template.loader import render_to_string
+from news.cache import CACHE_TIMEOUT, get_category_list, page_key
 from news.models import Category, Article
+from news.pagination import CursorPaginator
+from news.search import get_search_backend
+from news.syndication import get_feed
 
 NEWS_ARTICLE_PAGINATION = getattr(settings, 'NEWS_ARTICLE_PAGINATION', 10)
 
-def article_list(request, url_path='', template_name='news/article_list.html'):
-    extra_context = {'categories': Category.objects.all()}
+# whether a category's listing also shows the articles in its subcategories
+NEWS_INCLUDE_SUBCATEGORIES = getattr(settings, 'NEWS_INCLUDE_SUBCATEGORIES', False)
+
+# page through articles with before/after cursors instead of page numbers
+NEWS_CURSOR_PAGINATION = getattr(settings, 'NEWS_CURSOR_PAGINATION', False)
+
+# whether cursor paginated listings also count the total number of articles
+NEWS_CURSOR_PAGINATION_COUNT = getattr(settings, 'NEWS_CURSOR_PAGINATION_COUNT', False)
+
+# stands in for the category list in cached pages - the list changes with
+# every download, so it is filled in on each request
+CATEGORY_LIST_MARKER = '<!-- news:category_list -->'
+
+def article_list(request, url_path='', template_name='news/article_list.html',
+                 include_subcategories=NEWS_INCLUDE_SUBCATEGORIES):
+    if not CACHE_TIMEOUT or request.method != 'GET' or request.GET.get('q'):
+        return render_article_list(request, url_path, template_name,
+                                   include_subcategories)
     
+    # pages are cached until new articles arrive in the category or articles
+    # are expired, at which point the key changes
+    key = page_key(url_path, template_name, include_subcategories,
+                   sorted(request.GET.items()))
+    content = cache.get(key)
+    if content is None:
+        response = render_article_list(request, url_path, template_name,
+                                       include_subcategories, cached=True)
+        if response.status_code != 200:
+            return response
+        content = response.content
+        cache.set(key, content, CACHE_TIMEOUT)
+    return HttpResponse(content.replace(CATEGORY_LIST_MARKER, 
+        render_to_string('news/category_list.html',
+                         {'categories': get_category_list()},
+                         context_instance=RequestContext(request))))
+
+def render_article_list(request, url_path, template_name, include_subcategories,
+                        cached=False):
+    extra_context = {'categories': get_category_list()}
+    if cached:
+        extra_context['category_list_marker'] = CATEGORY_LIST_MARKER
+    
+    category = None
     if url_path != '':
         category = get_object_or_404(Category, url_path=url_path)
-        qs = category.articles.filter(expired=False)
         extra_context.update({'category': category})
-    else:
-        qs = Article.objects.filter(expired=False)
+    qs = Article.objects.listed(category, include_subcategories)
         
-    if request.GET.get('q', None):
-        qs = qs.filter(headline__icontains=request.GET['q'])
-        extra_context.update({'search_query': request.GET['q']})
+    # listings only show the teaser, so leave the full article text behind
+    qs = qs.defer('content')
+    
+    search_query = request.GET.get('q', None)
+    if search_query:
+        qs = get_search_backend().search(qs, search_query)
+        extra_context.update({'search_query': search_query})
         
+    before = request.GET.get('before', None)
+    after = request.GET.get('after', None)
+    if (NEWS_CURSOR_PAGINATION or before or after) and not search_query:
+        # search results are ordered by rank, so are always paged by number
+        return cursor_list(request, qs, template_name, extra_context, 
+                           before, after)
+    
     return object_list(
         request,
         queryset=qs,
+        template_name=template_name,
         template_object_name='article',
         extra_context=extra_context,
         paginate_by=NEWS_ARTICLE_PAGINATION,
         page=int(request.GET.get('page', 0))
     )
+
+def cursor_list(request, qs, template_name, extra_context, before, after):
+    """
+    Render a page of articles using keyset pagination.  The context mirrors
+    the one provided by object_list, with next_cursor and previous_cursor in
+    place of page numbers.
+    """
+    paginator = CursorPaginator(qs, NEWS_ARTICLE_PAGINATION)
+    try:
+        page = paginator.page(before=before, after=after)
+    except ValueError:
+        raise Http404
+    
+    context = {
+        'article_list': page['object_list'],
+        'is_paginated': page['has_next'] or page['has_previous'],
+        'has_next': page['has_next'],
+        'has_previous': page['has_previous'],
+        'next_cursor': page['next_cursor'],
+        'previous_cursor': page['previous_cursor'],
+    }
+    if NEWS_CURSOR_PAGINATION_COUNT:
+        context['hits'] = qs.count()
+    context.update(extra_context)
+    
+    return render_to_response(template_name, context,
+                              context_instance=RequestContext(request))
+
+def category_feed(request, format, url_path=''):
+    """
+    RSS or Atom feed of a category's latest articles.  Conditional requests
+    for a feed that has not changed get an empty 304 response.
+    """
+    feed = get_feed(url_path, format)
+    if feed is None:
+        raise Http404
+    
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if_modified_since = request.META.get('HTTP_IF_MODIFIED_SINCE')
+    if if_none_match or if_modified_since:
+        if ((not if_none_match or if_none_match == feed['etag']) and
+            (not if_modified_since or if_modified_since == feed['last_modified'])):
+            response = HttpResponseNotModified()
+            response['ETag'] = feed['etag']
+            return response
+    
+    response = HttpResponse(feed['content'], mimetype=feed['mime_type'])
+    response['ETag'] = feed['etag']
+    if feed['last_modified']:
+        response['Last-Modified'] = feed['last_modified']
+    return response